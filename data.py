@@ -8,6 +8,14 @@ import os
 import csv
 import math
 import re
+import io
+import itertools
+import collections
+import hashlib
+import json
+import struct
+import multiprocessing
+import shutil
 import numpy as np
 import pandas
 import torch
@@ -16,19 +24,85 @@ import torch.utils
 import torch.utils.data
 from sklearn.preprocessing import MultiLabelBinarizer
 #from embedding import Embedding, RandomEmbedding, TextEmbedding, FastTextEmbedding
-from utils import Index, AttributeHolder
+from utils import Index, AttributeHolder, compactIntType, tensorBytes
 
 
 from sklearn.datasets import fetch_20newsgroups
 import pickle
+
+'''
+spacy pipeline components needed for `pos_` and `lemma_`, everything else (parser, ner, ...) is disabled
+'''
+POS_COMPONENTS = ( 'tok2vec', 'tagger', 'attribute_ruler', 'lemmatizer' )
+
+def annotate(texts, cachefile, components = (), transform = None, batch_size = 1000, n_process = 1, chunksize = 10000):
+  '''
+  Run spacy over `texts` with `nlp.pipe`, only the pipeline `components` are enabled (the tokenizer
+  always runs). If given, `transform` is applied to each doc. The results are written in chunks of
+  `chunksize` texts next to `cachefile`, an interrupted run resumes with the first missing chunk
+  (chunks are keyed by a hash of `texts`, so chunks of other texts are never reused, they are
+  removed). The chunks are kept until the caller has saved the results and calls
+  `remove_annotations(cachefile)`.
+  '''
+  nchunks = (len(texts) + chunksize - 1) // chunksize
+  h = hashlib.sha1()
+  for text in texts:
+    h.update(text.encode('utf-8'))
+    h.update(b'\0')
+  texthash = h.hexdigest()[:16]
+  partfile = lambda i: f'{cachefile:s}.{len(texts):d}-{texthash:s}-{i:d}.part'
+  for stale in set(annotation_parts(cachefile)) - set(map(partfile, range(nchunks))):
+    os.remove(stale)
+  missing = [ i for i in range(nchunks) if not os.path.isfile(partfile(i)) ]
+  if missing:
+    print(f'Applying spacy to {len(texts):d} texts ({len(missing):d} of {nchunks:d} chunks missing).', file=sys.stderr)
+    import en_core_web_sm
+    nlp = en_core_web_sm.load()
+    disable = [ name for name in nlp.pipe_names if name not in components ]
+    # n_process is only known since spacy 2.2.2
+    kwargs = dict(n_process = n_process) if n_process > 1 else {}
+    for i in missing:
+      chunk = texts[i * chunksize:(i + 1) * chunksize]
+      docs = nlp.pipe(chunk, batch_size = batch_size, disable = disable, **kwargs)
+      docs = tqdm(docs, total = len(chunk), ncols = 89, desc = f'spacy {i+1:d}/{nchunks:d}')
+      docs = list(map(transform, docs) if transform is not None else docs)
+      with open(partfile(i) + '.tmp', 'wb') as f:
+        pickle.dump(docs, f, protocol = pickle.HIGHEST_PROTOCOL)
+      os.replace(partfile(i) + '.tmp', partfile(i))
+  results = []
+  for i in range(nchunks):
+    with open(partfile(i), 'rb') as f:
+      results.extend(pickle.load(f))
+  return results
+
+def annotation_parts(cachefile):
+  '''
+  The chunk files `annotate` wrote for `cachefile`.
+  '''
+  path, name = os.path.split(os.path.abspath(cachefile))
+  pattern = re.compile(re.escape(name) + r'\.\d+-[0-9a-f]+-\d+\.part')
+  return [ os.path.join(os.path.dirname(cachefile), f) for f in os.listdir(path) if pattern.fullmatch(f) ]
+
+def remove_annotations(cachefile):
+  '''
+  Remove the chunk files of `annotate`, once its results are saved elsewhere.
+  '''
+  for part in annotation_parts(cachefile):
+    os.remove(part)
     
 '''
 
 '''
 class SemEval2010(torch.utils.data.Dataset):
   
-  def __init__(self, path, subset = 'train.txt', nlines=None, maxseqlen=None, maxentlen=None, maxdist=60, nbos = 0, neos = 1, index = None, posiindex = None, classindex = None, rclassindex = None, dclassindex = None, eclassindex = None, compact=True):
+  def __init__(self, path, subset = 'train.txt', nlines=None, maxseqlen=None, maxentlen=None, maxdist=60, nbos = 0, neos = 1, index = None, posiindex = None, classindex = None, rclassindex = None, dclassindex = None, eclassindex = None, compact=True, cache=True, tokenizer='spacy', nlp_batch_size=1000, nlp_processes=1):
+    if tokenizer not in [ 'spacy', 'regex' ]:
+      raise ValueError(f'Invalid tokenizer `{tokenizer}`, expected `spacy` or `regex`.')
     self.path = path
+    self.tokenizer = tokenizer
+    self.cache = cache
+    self.nlp_batch_size = nlp_batch_size
+    self.nlp_processes = nlp_processes
     self.subset = subset
     self.maxseqlen = maxseqlen
     self.maxdist = maxdist
@@ -43,46 +117,49 @@ class SemEval2010(torch.utils.data.Dataset):
     self.rclassindex = rclassindex if rclassindex is not None else Index()
     self.dclassindex = dclassindex if dclassindex is not None else Index()
     self.eclassindex = eclassindex if eclassindex is not None else Index()
-    self.posiindex = posiindex if eclassindex is not None else Index(initwords = [ maxdist, -maxdist ], unkindex = 0)
+    self.posiindex = posiindex if posiindex is not None else Index(initwords = [ maxdist, -maxdist ], unkindex = 0)
     self.maxentlen = maxentlen
     self.load(nlines, compact)
     self.device = torch.device('cpu')
     self.deviceTensor = torch.LongTensor().to(self.device) # create tensor on device, which can be used for copying
     
   @staticmethod
-  def process_label(label):
-    rval = AttributeHolder(label = label) # Product-Producer(e2,e1)
-    rval.rlabel = re.sub(r'\(.*$', '', label) # Product-Producer
-    rval.etypes = rval.rlabel.split('-')
-    if len(rval.etypes) < 2:
-      rval.dlabel = 'e1 - e2'
-      rval.e1label = rval.rlabel
-      rval.e2label = rval.rlabel
-    else:
-      rval.dlabel = re.sub(r'^[^(]+', '', label) # (e2,e1)
-      idx_e1 = rval.dlabel.find('e1')
-      idx_e2 = rval.dlabel.find('e2')
-      e1_first = idx_e1 < idx_e2
-      rval.e1label = rval.etypes[not e1_first] # == 0
-      rval.e2label = rval.etypes[e1_first] # == 1
-      rval.dlabel = 'e1 > e2' if e1_first else 'e1 < e2'
-    return rval
-  
-  def label_to_index(self, labelobj):
-    return AttributeHolder(
-        label=self.classindex.add(labelobj.label),
-        rlabel=self.rclassindex.add(labelobj.rlabel),
-        dlabel=self.dclassindex.add(labelobj.dlabel),
-        e1label=self.eclassindex.add(labelobj.e1label),
-        e2label=self.eclassindex.add(labelobj.e2label))
-    
-  def get_offsets_spacy(self, row, col):
-    doc = row.spacy
-    # offsets e1, e2
-    b = next((t.i for t in doc if t.idx >= row[col][0]), None)
-    e = next((t.i for t in doc if t.idx >= row[col][1]), None)
-    return (b, e)
-  
+  def process_labels(labels):
+    '''
+    Split the labels into relation, direction and entity type labels, e.g.
+      Product-Producer(e2,e1) => Product-Producer | e1 < e2 | Producer | Product
+      Other                   => Other            | e1 - e2 | Other    | Other
+    '''
+    rlabels = labels.str.replace(r'\(.*$', '', regex=True) # Product-Producer
+    etypes = rlabels.str.split('-', expand=True)
+    if etypes.shape[1] < 2:
+      etypes[1] = None
+    notypes = etypes[1].isna().values
+    directions = labels.str.replace(r'^[^(]+', '', regex=True) # (e2,e1)
+    e1_first = (directions.str.find('e1') < directions.str.find('e2')).values
+    return pandas.DataFrame(dict(
+        label = labels.values,
+        rlabel = rlabels.values,
+        dlabel = np.where(notypes, 'e1 - e2', np.where(e1_first, 'e1 > e2', 'e1 < e2')),
+        e1label = np.where(notypes, rlabels.values, np.where(e1_first, etypes[0].values, etypes[1].values)),
+        e2label = np.where(notypes, rlabels.values, np.where(e1_first, etypes[1].values, etypes[0].values))),
+        index = labels.index)
+
+  @staticmethod
+  def token_offsets(docs, charoffsets):
+    '''
+    For every doc, the index of the first token which starts at or after the corresponding
+    character offset, `len(doc)` if there is none.
+    '''
+    doclens = np.fromiter(map(len, docs), dtype=np.int64, count=len(docs))
+    docstarts = np.zeros(len(docs) + 1, dtype=np.int64)
+    np.cumsum(doclens, out=docstarts[1:])
+    tokenstarts = np.fromiter((t.idx for doc in docs for t in doc), dtype=np.int64, count=docstarts[-1])
+    # shift every doc by a multiple of a constant larger than any offset, so all docs can be searched at once
+    shift = np.arange(len(docs), dtype=np.int64) * (max(tokenstarts.max(initial=0), charoffsets.max(initial=0)) + 1)
+    positions = np.searchsorted(tokenstarts + np.repeat(shift, doclens), charoffsets + shift, side='left')
+    return positions - docstarts[:-1]
+
   def transform_token(self, t):
     if isinstance(t, str):
       return t
@@ -95,161 +172,411 @@ class SemEval2010(torch.utils.data.Dataset):
 #      return '00#$'
 #    return t.lemma_.lower() + '#' + t.tag_[0].upper()
 
-  def make_sequence_tensor(self, row, placeholder_e = False):
-    doc = row.spacy      
+  '''
+  entity markers, numbers, words (contractions are split off like spacy does) and single punctuation or symbol characters
+  '''
+  TOKEN_PATTERN = re.compile(r"(?P<marker></?e[12]>)|(?P<number>\d+(?:[.,:/]\d+)*(?!\w))|(?P<word>\w+(?=n't\b)|n't\b|'(?:s|re|ve|ll|d|m)\b|\w+)|(?P<punct>[^\w\s])", re.IGNORECASE)
 
-    # keep track of offsets e1 and e2
-    temp_seq_e1 = [False] * len(doc)
-    temp_seq_e1[row.offset_e1_spacy[0]:row.offset_e1_spacy[1]] = [True] * (row.offset_e1_spacy[1]-row.offset_e1_spacy[0])
-    
-    temp_seq_e2 = [False] * len(doc)
-    temp_seq_e2[row.offset_e2_spacy[0]:row.offset_e2_spacy[1]] = [True] * (row.offset_e2_spacy[1]-row.offset_e2_spacy[0])
-    
-    s = map(self.transform_token, doc)
-    s = zip(s, temp_seq_e1, temp_seq_e2)
-    
-    s = filter(lambda t : t[0] is not None, s)
-    s = map(lambda t: (self.index.add(t[0]), t[1], t[2]), s)
-    s = list(s)
-
-    # add sentence begin and sentence end markers
-    for i in range(self.nbos):
-      s.insert(0, (self.bosidx, False, False))
-    for i in range(max(self.neos, 1)):
-      s.append((self.eosidx, False, False))
-      
-    seq, temp_seq_e1,  temp_seq_e2 = list(zip(*s))
-    seq = torch.LongTensor(seq)
-    row['e1_in_seq'] = temp_seq_e1.index(True)
-    row['e1_in_seq'] = (row.e1_in_seq, temp_seq_e1.index(False, row.e1_in_seq))
-    row['e2_in_seq'] = temp_seq_e2.index(True)
-    row['e2_in_seq'] = (row.e2_in_seq, temp_seq_e2.index(False, row.e2_in_seq))
-    row['seq_e1'] = seq[range(row.e1_in_seq[1]-1, row.e1_in_seq[0]-1, -1)] # save entities in reversed order
-    row['seq_e2'] = seq[range(row.e2_in_seq[1]-1, row.e2_in_seq[0]-1, -1)]
-    row['seqlen_e1'] = row.seq_e1.size(0)
-    row['seqlen_e2'] = row.seq_e2.size(0)    
-
-    if placeholder_e:
-      e1 = self.index.add('<e1>')
-      e2 = self.index.add('<e2>')
-      seq = torch.cat((
-          seq[:row.e1_in_seq[0]],
-          torch.LongTensor([e1]),
-          seq[row.e1_in_seq[1]:row.e2_in_seq[0]],
-          torch.LongTensor([e2]),
-          seq[row.e2_in_seq[1]:]))
-      row['e1_in_seq'] = (seq == e1).nonzero()[0,0].item()
-      row['e1_in_seq'] = (row.e1_in_seq, row.e1_in_seq+1)
-      row['e2_in_seq'] = (seq == e2).nonzero()[0,0].item()
-      row['e2_in_seq'] = (row.e2_in_seq, row.e2_in_seq+1)  
-    row['seq'] = torch.LongTensor(seq)
-    row['seqlen'] = seq.size(0)
-    
-    return row
-  
-  def pad(self, x, length, padval):
-    y = torch.ones((length,)).long() * padval
-    y[:min(len(x), length)] = x[:min(len(x), length)]
-    return y
-  
-  def load(self, nlines, compact=True):
-    source_file = os.path.join(self.path, self.subset)
-    processed_file = source_file + '.pkl'
-    if nlines:
-      processed_file = processed_file + f'_{nlines:d}'      
-    
-    # do some preprocessing if preprocessed file does not exist
-    if not os.path.isfile(processed_file):
-      #import spacy; nlp=spacy.load('en')
-      print('Applying spacy.')
-      import en_core_web_sm
-      nlp = en_core_web_sm.load()
-      tqdm.pandas()
+  @classmethod
+  def tokenize(cls, sentence):
+    '''
+    Rule based alternative to spacy: split a sentence with entity markers into tokens, normalized
+    like `transform_token` (punctuation and symbols are dropped, numbers become '0'), and record the
+    token offsets of the entities in the same pass. Returns `tokens, (b1, e1), (b2, e2)`.
+    '''
+    tokens = []
+    offsets = {}
+    for m in cls.TOKEN_PATTERN.finditer(sentence):
+      if m.lastgroup == 'word':
+        tokens.append(m.group())
+      elif m.lastgroup == 'number':
+        tokens.append('0')
+      elif m.lastgroup == 'marker':
+        offsets[m.group().lower()] = len(tokens)
+    return tokens, (offsets['<e1>'], offsets['</e1>']), (offsets['<e2>'], offsets['</e2>'])
+
+  def preprocess(self, source_file, processed_file, nlines, offset = 0):
+    # start reading at byte `offset`, e.g. to process only lines which were appended
+    with open(source_file, 'rb') as f:
+      f.seek(offset)
       samples = pandas.read_csv(
-          source_file,
+          f,
           sep='\t',
-          delim_whitespace = False,
           quoting=csv.QUOTE_MINIMAL,
           names=['id', 'originalsentence', 'labels', 'comment'],
           skip_blank_lines=True,
           encoding='utf-8',
           nrows=nlines)
-      samples['original_offset_e1'] = samples.originalsentence.apply(lambda s: (s.find('<e1>'), s.find('</e1>')))
-      samples['original_offset_e2'] = samples.originalsentence.apply(lambda s: (s.find('<e2>'), s.find('</e2>')))
-      samples['e1'] = samples.apply(lambda row: row.originalsentence[row.original_offset_e1[0] + 4:row.original_offset_e1[1]].strip(), axis=1)
-      samples['e2'] = samples.apply(lambda row: row.originalsentence[row.original_offset_e2[0] + 4:row.original_offset_e2[1]].strip(), axis=1)
-      samples['l'] = samples.apply(lambda row: row.originalsentence[:row.original_offset_e1[0]].strip(), axis=1)
-      samples['r'] = samples.apply(lambda row: row.originalsentence[row.original_offset_e2[1]+5:].strip(), axis=1)
-      samples['m'] = samples.apply(lambda row: row.originalsentence[row.original_offset_e1[1]+5:row.original_offset_e2[0]].strip(), axis=1)
-      samples['sentence'] = samples.apply(lambda row: row.l+' '+row.e1+' '+row.m+' '+row.e2+' '+row.r, axis=1)
-      samples['offset_e1'] = samples.apply(lambda row: (len(row.l)+1, len(row.l)+1+len(row.e1)), axis=1)
-      samples['offset_e2'] = samples.apply(lambda row: (len(row.l)+1+len(row.e1)+1+len(row.m)+1, len(row.l)+1+len(row.e1)+1+len(row.m)+1+len(row.e2)), axis=1)
-      samples['spacy'] = samples.sentence.progress_apply(lambda s: nlp(s))
-      samples['offset_e1_spacy']= samples.apply(lambda r: self.get_offsets_spacy(r, 'offset_e1'), axis=1)
-      samples['offset_e2_spacy']= samples.apply(lambda r: self.get_offsets_spacy(r, 'offset_e2'), axis=1)
-      samples.to_pickle(processed_file)
-      del samples
-
-    # load processed messages
-    self.samples = pandas.read_pickle(processed_file)    
-    self.samples = self.samples.apply(lambda r: self.make_sequence_tensor(r, placeholder_e = True), axis=1)
-
-    # pad
+    parts = samples.originalsentence.str.extract(r'^(?P<l>.*?)<e1>(?P<e1>.*?)</e1>(?P<m>.*?)<e2>(?P<e2>.*?)</e2>(?P<r>.*)$')
+    for col in [ 'e1', 'e2', 'l', 'r', 'm' ]:
+      samples[col] = parts[col].str.strip()
+    samples['sentence'] = samples.l + ' ' + samples.e1 + ' ' + samples.m + ' ' + samples.e2 + ' ' + samples.r
+    # character offsets of the entities in `sentence`
+    b1 = samples.l.str.len().values + 1
+    e1 = b1 + samples.e1.str.len().values
+    b2 = e1 + 1 + samples.m.str.len().values + 1
+    e2 = b2 + samples.e2.str.len().values
+    samples['offset_e1'] = list(zip(b1, e1))
+    samples['offset_e2'] = list(zip(b2, e2))
+    if self.tokenizer == 'regex':
+      samples['tokens'], samples['offset_e1_tokens'], samples['offset_e2_tokens'] = zip(*map(self.tokenize, tqdm(samples.originalsentence, ncols=89, desc='tokenize')))
+      return samples
+    samples['spacy'] = annotate(samples.sentence.tolist(), processed_file, components = POS_COMPONENTS, batch_size = self.nlp_batch_size, n_process = self.nlp_processes)
+    docs = samples.spacy.tolist()
+    samples['offset_e1_spacy'] = list(zip(self.token_offsets(docs, b1), self.token_offsets(docs, e1)))
+    samples['offset_e2_spacy'] = list(zip(self.token_offsets(docs, b2), self.token_offsets(docs, e2)))
+    return samples
+
+  def make_sequence_tensors(self, docs, offs_e1, offs_e2):
+    '''
+    Encode all sentences (spacy docs or token lists) at once into a padded (nsamples x maxseqlen)
+    matrix where the entities, given as token offsets, are replaced by the placeholders '<e1>' and '<e2>',
+    plus the (reversed) entity token matrices, the sequence lengths and the placeholder offsets.
+    '''
+    n = len(docs)
+    doclens = np.fromiter(map(len, docs), dtype=np.int64, count=n)
+    docstarts = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(doclens, out=docstarts[1:])
+    words = [ self.transform_token(t) for doc in docs for t in doc ]
+    nkept = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((w is not None for w in words), dtype=bool, count=len(words)), out=nkept[1:])
+    kept_before = lambda tokenoffsets: nkept[docstarts[:-1] + tokenoffsets] - nkept[docstarts[:-1]]
+    ntokens = kept_before(doclens)
+    offs_e1 = np.array(offs_e1, dtype=np.int64).reshape(-1, 2)
+    offs_e2 = np.array(offs_e2, dtype=np.int64).reshape(-1, 2)
+    # entity boundaries in terms of the remaining tokens
+    b1, e1, b2, e2 = kept_before(offs_e1[:,0]), kept_before(offs_e1[:,1]), kept_before(offs_e2[:,0]), kept_before(offs_e2[:,1])
+    len1, len2 = e1 - b1, e2 - b2
+
+    # encode; the placeholders are encoded after the tokens of each sentence, as they always were
+    words = [ w for w in words if w is not None ]
+    tokenstarts = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(ntokens, out=tokenstarts[1:])
+    ids, offsets = self.index.encode_batch([ words[tokenstarts[i]:tokenstarts[i+1]] + [ '<e1>', '<e2>' ] for i in range(n) ])
+    ids = np.delete(ids, np.concatenate((offsets[1:] - 2, offsets[1:] - 1)))
+    e1idx, e2idx = self.index.getId('<e1>'), self.index.getId('<e2>')
+    rows = np.repeat(np.arange(n), ntokens)
+    j = np.arange(len(ids)) - tokenstarts[rows] # position of the token in its sentence
+    in_e1 = (j >= b1[rows]) & (j < e1[rows])
+    in_e2 = (j >= b2[rows]) & (j < e2[rows])
+
+    # sentence with placeholders: <s>* l <e1> m <e2> r </s>+
+    p1 = self.nbos + b1
+    p2 = self.nbos + b2 - len1 + 1
+    seqlen = self.nbos + ntokens - len1 - len2 + 2 + self.neos
     if not self.maxseqlen:
-      self.maxseqlen = self.samples.seqlen.max()      
+      self.maxseqlen = int(seqlen.max())
     if not self.maxentlen:
-      self.maxentlen = max(self.samples.seqlen_e1.max(), self.samples.seqlen_e2.max())
-    
-    self.samples['seq'] = self.samples.seq.apply(lambda s: self.pad(s, self.maxseqlen, self.padidx))
-    self.samples['seqlen'] = self.samples.seqlen.apply(lambda l: min(l, self.maxseqlen))
-    self.samples['e1_in_seq'] = self.samples.e1_in_seq.apply(lambda tup: (min(tup[0], self.maxseqlen), min(tup[1], self.maxseqlen)))
-    self.samples['e2_in_seq'] = self.samples.e2_in_seq.apply(lambda tup: (min(tup[0], self.maxseqlen), min(tup[1], self.maxseqlen)))
-    self.samples['seq_e1'] = self.samples.seq_e1.apply(lambda s: self.pad(s, self.maxentlen, self.epadidx))
-    self.samples['seq_e2'] = self.samples.seq_e2.apply(lambda s: self.pad(s, self.maxentlen, self.epadidx))
-    # create the position vectors (relative distance to the beginning of the entities)
-    self.samples['e1_posi_seq'] = self.samples.e1_in_seq.apply(lambda offs_e1: torch.LongTensor(list(map(self.posiindex.add, map(lambda d: max(d, -self.maxdist) if d < 0 else min(d, self.maxdist), map(lambda i: i-offs_e1[0], range(self.maxseqlen)))))))
-    self.samples['e2_posi_seq'] = self.samples.e2_in_seq.apply(lambda offs_e2: torch.LongTensor(list(map(self.posiindex.add, map(lambda d: max(d, -self.maxdist) if d < 0 else min(d, self.maxdist), map(lambda i: i-offs_e2[0], range(self.maxseqlen)))))))
-
-    # prep labels
-    self.samples['labels'] = self.samples.labels.apply(self.process_label)
-    self.samples['labelids'] = self.samples.labels.apply(self.label_to_index)
+      self.maxentlen = int(max(len1.max(), len2.max()))
+    L, E = self.maxseqlen, self.maxentlen
+    cols = self.nbos + j + np.where(j >= e1[rows], 1 - len1[rows], 0) + np.where(j >= e2[rows], 1 - len2[rows], 0)
+    seq = np.full((n, L), self.padidx, dtype=np.int64)
+    m = ~in_e1 & ~in_e2 & (cols < L)
+    seq[rows[m], cols[m]] = ids[m]
+    seq[:, :min(self.nbos, L)] = self.bosidx
+    r = np.arange(n)
+    seq[r[p1 < L], p1[p1 < L]] = e1idx
+    seq[r[p2 < L], p2[p2 < L]] = e2idx
+    eoscols = (seqlen - self.neos)[:, None] + np.arange(self.neos)[None, :]
+    m = eoscols < L
+    seq[np.repeat(r, self.neos).reshape(n, -1)[m], eoscols[m]] = self.eosidx
+
+    # entities in reversed order
+    seq_e1 = np.full((n, E), self.epadidx, dtype=np.int64)
+    cols = e1[rows] - 1 - j
+    m = in_e1 & (cols < E)
+    seq_e1[rows[m], cols[m]] = ids[m]
+    seq_e2 = np.full((n, E), self.epadidx, dtype=np.int64)
+    cols = e2[rows] - 1 - j
+    m = in_e2 & (cols < E)
+    seq_e2[rows[m], cols[m]] = ids[m]
+
+    return AttributeHolder(
+        seq = torch.from_numpy(seq),
+        seqlen = torch.from_numpy(np.minimum(seqlen, L)),
+        e1_in_seq = torch.from_numpy(np.minimum(np.stack((p1, p1 + 1), axis=1), L)),
+        e2_in_seq = torch.from_numpy(np.minimum(np.stack((p2, p2 + 1), axis=1), L)),
+        seq_e1 = torch.from_numpy(seq_e1),
+        seqlen_e1 = torch.from_numpy(len1),
+        seq_e2 = torch.from_numpy(seq_e2),
+        seqlen_e2 = torch.from_numpy(len2))
+
+  def make_position_tensors(self, offs_e1, offs_e2):
+    '''
+    Relative distance of every position to the beginning of the entities, clipped to `maxdist`.
+    Distances are mapped to ids with a lookup table over [-maxdist, maxdist], a frozen `posiindex`
+    is only read, otherwise new distances are added in order of appearance.
+    '''
+    offsets = torch.stack((offs_e1, offs_e2)).long()
+    d = (torch.arange(self.maxseqlen)[None, None, :] - offsets[:, :, None]).clamp_(-self.maxdist, self.maxdist).add_(self.maxdist)
+    flat = d.view(-1).numpy()
+    distances = np.arange(-self.maxdist, self.maxdist + 1)
+    table = np.full(len(distances), -1, dtype=np.int64)
+    occurring, first = np.unique(flat, return_index=True)
+    occurring = occurring[np.argsort(first)]
+    if self.posiindex.frozen:
+      table[occurring], _ = self.posiindex.encode_batch([ distances[occurring].tolist() ], grow = False)
+    else:
+      counts = np.bincount(flat, minlength=len(distances))
+      table[occurring] = self.posiindex.merge(distances[occurring].tolist(), counts[occurring].tolist())
+    ids = torch.from_numpy(table)[d]
+    return ids[0], ids[1]
+
+  def make_label_tensors(self, labels):
+    e1e2labels, _ = self.eclassindex.encode_batch([ np.stack((labels.e1label.values, labels.e2label.values), axis=1).ravel().tolist() ])
+    e1e2labels = torch.from_numpy(e1e2labels).view(-1, 2)
+    return AttributeHolder(
+        label = torch.from_numpy(self.classindex.encode_batch([ labels.label.tolist() ])[0]),
+        rlabel = torch.from_numpy(self.rclassindex.encode_batch([ labels.rlabel.tolist() ])[0]),
+        dlabel = torch.from_numpy(self.dclassindex.encode_batch([ labels.dlabel.tolist() ])[0]),
+        e1label = e1e2labels[:,0],
+        e2label = e1e2labels[:,1])
+  
+  CACHE_VERSION = 2
+
+  def indexes(self):
+    # name, index, type of the index entries
+    return [ ('index', self.index, str), ('posiindex', self.posiindex, int), ('classindex', self.classindex, str), ('rclassindex', self.rclassindex, str), ('dclassindex', self.dclassindex, str), ('eclassindex', self.eclassindex, str) ]
+
+  def cachekey(self, source_file, nlines, compact):
+    '''
+    Hash over everything that determines the encoded tensors apart from the content of the source
+    file: all preprocessing parameters, `transform_token`, the state of the indexes before loading
+    and the versions of the libraries involved. The cached content is checked with `cachedsize`.
+    '''
+    versions = None
+    if self.tokenizer == 'spacy':
+      try:
+        import spacy
+        import en_core_web_sm
+        versions = (spacy.__version__, getattr(en_core_web_sm, '__version__', None))
+      except ImportError:
+        pass
+    transform = self.transform_token.__func__.__code__
+    tokenize = self.tokenize.__func__.__code__
+    return hashlib.sha1(repr((
+        self.CACHE_VERSION, nlines, compact,
+        self.maxseqlen, self.maxentlen, self.maxdist, self.nbos, self.neos,
+        transform.co_code, transform.co_consts, self.tokenizer, self.TOKEN_PATTERN.pattern, tokenize.co_code, tokenize.co_consts,
+        [ index.fingerprint() for _, index, _ in self.indexes() ],
+        versions, np.__version__, pandas.__version__, torch.__version__)).encode('utf8')).hexdigest()
+
+  def cachedsize(self, cachedir, source_file):
+    '''
+    Number of bytes of `source_file` the cache in `cachedir` was built from, None if there is
+    no cache or the file was changed other than by appending complete lines.
+    '''
+    if not os.path.isfile(os.path.join(cachedir, 'source.txt')):
+      return None
+    with open(os.path.join(cachedir, 'source.txt')) as f:
+      size, filehash, lastbyte = f.read().split()
+    size = int(size)
+    if size > os.path.getsize(source_file) or FixedLengthSequenceDataset.filehash(source_file, size = size) != filehash:
+      return None
+    if size < os.path.getsize(source_file) and lastbyte != '0a':
+      return None # the last line was continued
+    return size
+
+  def load_cached(self, cachedir):
+    '''
+    Restore the tensors (memory mapped) and the state of the indexes from `cachedir`.
+    '''
+    print(f'Loading cached {self.subset:s} from {cachedir:s}', file=sys.stderr)
+    for name, index, totype in self.indexes():
+      vocab = Index.fromfile(os.path.join(cachedir, name + '.vocab'))
+      for w in vocab.id2w[len(index):]:
+        index.add(totype(w))
+      if not index.frozen:
+        index.counts = collections.Counter({ i: int(c) for i, c in enumerate(vocab.counts) if c > 0 })
+    with open(os.path.join(cachedir, 'samples.pkl'), 'rb') as f:
+      meta = pickle.load(f)
+    self.samples = meta['samples']
+    self.maxseqlen, self.maxentlen, self.nbytes_long = meta['maxseqlen'], meta['maxentlen'], meta['nbytes_long']
+    self.tensors = AttributeHolder()
+    for col in meta['tensors']:
+      self.tensors[col] = torch.from_numpy(np.load(os.path.join(cachedir, col + '.npy'), mmap_mode='c'))
+    return True
+
+  def save_cached(self, cachedir, source_file, size):
+    '''
+    Store the tensors as `.npy` files, the indexes in binary format, the sample information and
+    the hash of the first `size` bytes of the source file. The directory is written under a
+    temporary name and replaces an existing cache when complete.
+    '''
+    tmpdir = cachedir + '.tmp'
+    os.makedirs(tmpdir, exist_ok=True)
+    with open(source_file, 'rb') as f:
+      f.seek(max(size - 1, 0))
+      lastbyte = f.read(1).hex() or '00'
+    with open(os.path.join(tmpdir, 'source.txt'), 'w') as f:
+      print(size, FixedLengthSequenceDataset.filehash(source_file, size = size), lastbyte, file=f)
+    for name, index, _ in self.indexes():
+      index.tofile(os.path.join(tmpdir, name + '.vocab'), binary = True)
+    for col, tensor in self.tensors.__dict__.items():
+      np.save(os.path.join(tmpdir, col + '.npy'), tensor.numpy())
+    with open(os.path.join(tmpdir, 'samples.pkl'), 'wb') as f:
+      pickle.dump(dict(samples = self.samples, maxseqlen = self.maxseqlen, maxentlen = self.maxentlen, nbytes_long = self.nbytes_long, tensors = list(self.tensors.__dict__)), f, protocol = pickle.HIGHEST_PROTOCOL)
+    if os.path.isdir(cachedir):
+      os.replace(cachedir, cachedir + '.old')
+      shutil.rmtree(cachedir + '.old')
+    os.replace(tmpdir, cachedir)
+
+  def load(self, nlines, compact=True):
+    source_file = os.path.join(self.path, self.subset)
+    processed_file = source_file + ('.pkl' if self.tokenizer == 'spacy' else f'.{self.tokenizer:s}.pkl')
+    if nlines:
+      processed_file = processed_file + f'_{nlines:d}'      
     
-    # reconstructed sequence for debugging purposes
-    self.samples['seq_recon'] = self.samples.seq.apply(lambda t: np.array(list(self.index[t.tolist()])))
-          
+    if self.cache:
+      # a cache is reused as long as lines were only appended to the source file, only the new lines are processed
+      cachedir = f'{source_file:s}.cache-{self.cachekey(source_file, nlines, compact)[:16]:s}'
+      size = self.cachedsize(cachedir, source_file)
+      if size is not None:
+        self.load_cached(cachedir)
+        if nlines or size == os.path.getsize(source_file):
+          return True
+        print(f'Appending {os.path.getsize(source_file) - size:d} new bytes of {self.subset:s}', file=sys.stderr)
+        processed_file = processed_file + f'.{size:d}'
+        self.append(self.preprocess(source_file, processed_file, None, offset = size), compact)
+      else:
+        self.tensors, self.samples = self.encode(self.preprocess(source_file, processed_file, nlines), compact)
+      self.save_cached(cachedir, source_file, os.path.getsize(source_file))
+      remove_annotations(processed_file)
+      return True
+
+    # do some preprocessing if preprocessed file does not exist
+    if not os.path.isfile(processed_file):
+      self.preprocess(source_file, processed_file, nlines).to_pickle(processed_file)
+      remove_annotations(processed_file)
+
+    # load processed messages and encode them into one tensor per field
+    self.tensors, self.samples = self.encode(pandas.read_pickle(processed_file), compact)
     return True
+
+  def encode(self, samples, compact = True):
+    '''
+    Encode preprocessed samples into one tensor per field, returns the tensors and the plain sample information.
+    '''
+    column = 'spacy' if self.tokenizer == 'spacy' else 'tokens'
+    t = self.make_sequence_tensors(samples[column].tolist(), samples[f'offset_e1_{column:s}'].tolist(), samples[f'offset_e2_{column:s}'].tolist())
+    t.e1_posi_seq, t.e2_posi_seq = self.make_position_tensors(t.e1_in_seq[:,0], t.e2_in_seq[:,0])
+    labels = self.process_labels(samples.labels)
+    for k, v in self.make_label_tensors(labels).__dict__.items():
+      t[k] = v
+    t.id = torch.from_numpy(samples.id.values.astype(np.int64))
+    self.nbytes_long = getattr(self, 'nbytes_long', 0) + sum(t[col].numel() * 8 for col in self.MATRICES)
+    if compact:
+      self.compacted(t)
+
+    # keep the plain sample information, e.g. for inspection or length based batching
+    samples = samples.drop(columns=[column])
+    for col in [ 'seqlen', 'seqlen_e1', 'seqlen_e2' ]:
+      samples[col] = t[col].numpy()
+    for col in [ 'rlabel', 'dlabel', 'e1label', 'e2label' ]:
+      samples[col] = labels[col]
+    return t, samples
+
+  def compacted(self, t):
+    # store ids in the smallest possible type, `__getitem__` widens them again via `new_tensor`
+    wordtype = compactIntType(len(self.index))
+    positype = compactIntType(len(self.posiindex))
+    for col, dtype in [ ('seq', wordtype), ('seq_e1', wordtype), ('seq_e2', wordtype), ('e1_posi_seq', positype), ('e2_posi_seq', positype) ]:
+      t[col] = t[col].to(dtype)
+    return t
+
+  def append(self, samples, compact = True):
+    '''
+    Encode further preprocessed samples and add them to the store. The indexes grow as for the
+    existing samples (frozen indexes map unknown entries to `unkindex`). `maxseqlen` and
+    `maxentlen` are kept, longer sentences and entities are cut.
+    '''
+    t, samples = self.encode(samples, compact = False)
+    self.samples = pandas.concat((self.samples, samples), ignore_index = True)
+    for col, tensor in t.__dict__.items():
+      self.tensors[col] = torch.cat((self.tensors[col].long(), tensor))
+    if compact:
+      self.compacted(self.tensors)
+    return self
+
+  MATRICES = [ 'seq', 'seq_e1', 'seq_e2', 'e1_posi_seq', 'e2_posi_seq' ]
+
+  def nbytes(self):
+    return tensorBytes(*[ self.tensors[col] for col in self.MATRICES ])
   
   def __len__(self):
     return self.samples.shape[0]
 
   def __getitem__(self, index):
-    r  = self.samples.iloc[index]
-    s  = r.seq
-    sl = r.seqlen
+    t  = self.tensors
+    s  = t.seq[index]
+    sl = t.seqlen[index].item()
 
-    e1_posi_seq = r.e1_posi_seq
-    e2_posi_seq = r.e2_posi_seq    
+    e1_posi_seq = t.e1_posi_seq[index]
+    e2_posi_seq = t.e2_posi_seq[index]
     
-    e1_offs = r.e1_in_seq
-    e1      = r.seq_e1
-    e1_len  = r.seqlen_e1
-    e2_offs = r.e2_in_seq
-    e2      = r.seq_e2
-    e2_len  = r.seqlen_e2
+    e1_offs = t.e1_in_seq[index].tolist()
+    e1      = t.seq_e1[index]
+    e1_len  = t.seqlen_e1[index].item()
+    e2_offs = t.e2_in_seq[index].tolist()
+    e2      = t.seq_e2[index]
+    e2_len  = t.seqlen_e2[index].item()
     
     # left, right and middle as indices (from,to)
     left  = torch.LongTensor([0, e1_offs[0]])
     right = torch.LongTensor([e2_offs[1], sl])
     mid   = torch.LongTensor([e1_offs[1], e2_offs[0]])
     
-    label   = r.labelids.label
-    e1label = r.labelids.e1label
-    e2label = r.labelids.e2label
-    rlabel  = r.labelids.rlabel
-    dlabel  = r.labelids.dlabel
+    label   = t.label[index].item()
+    e1label = t.e1label[index].item()
+    e2label = t.e2label[index].item()
+    rlabel  = t.rlabel[index].item()
+    dlabel  = t.dlabel[index].item()
         
     d = self.deviceTensor    
-    return d.new_tensor(index), d.new_tensor(r.id), d.new_tensor(s), d.new_tensor(sl), d.new_tensor(e1_posi_seq), d.new_tensor(e2_posi_seq),  d.new_tensor(left), d.new_tensor(e1_offs), d.new_tensor(mid), d.new_tensor(e2_offs), d.new_tensor(right), d.new_tensor(e1), d.new_tensor(e1_len), d.new_tensor(e2), d.new_tensor(e2_len), d.new_tensor(label), d.new_tensor(e1label), d.new_tensor(e2label), d.new_tensor(rlabel), d.new_tensor(dlabel)
+    return d.new_tensor(index), d.new_tensor(t.id[index].item()), d.new_tensor(s), d.new_tensor(sl), d.new_tensor(e1_posi_seq), d.new_tensor(e2_posi_seq),  d.new_tensor(left), d.new_tensor(e1_offs), d.new_tensor(mid), d.new_tensor(e2_offs), d.new_tensor(right), d.new_tensor(e1), d.new_tensor(e1_len), d.new_tensor(e2), d.new_tensor(e2_len), d.new_tensor(label), d.new_tensor(e1label), d.new_tensor(e2label), d.new_tensor(rlabel), d.new_tensor(dlabel)
+
+  def getbatch(self, indices):
+    '''
+    Fetch all `indices` at once, every field is gathered from the tensor store with a single
+    indexing operation. Returns the same fields as `default_collate` over `__getitem__` would.
+    '''
+    t = self.tensors
+    indices = torch.as_tensor(indices, dtype=torch.long)
+    batch = [ indices ] + [ t[col][indices].long() for col in [ 'id', 'seq', 'seqlen', 'e1_posi_seq', 'e2_posi_seq', 'e1_in_seq', 'e2_in_seq', 'seq_e1', 'seqlen_e1', 'seq_e2', 'seqlen_e2', 'label', 'e1label', 'e2label', 'rlabel', 'dlabel' ] ]
+    i, sid, s, sl, e1_posi_seq, e2_posi_seq, e1_offs, e2_offs = batch[:8]
+    # left, right and middle as indices (from,to)
+    left  = torch.stack((torch.zeros_like(sl), e1_offs[:,0]), dim=1)
+    right = torch.stack((e2_offs[:,1], sl), dim=1)
+    mid   = torch.stack((e1_offs[:,1], e2_offs[:,0]), dim=1)
+    batch = batch[:6] + [ left, e1_offs, mid, e2_offs, right ] + batch[8:]
+    return [ b.to(self.device) for b in batch ]
+
+  __getitems__ = None # the DataLoader only fetches whole batches if this is set, see `batched()`
+
+  def batched(self, batched = True):
+    '''
+    Let the DataLoader fetch whole batches with `getbatch` instead of single items,
+    use it together with `collate_fn = SemEval2010.collate_batch`.
+    '''
+    self.__getitems__ = self.getbatch if batched else None
+    return self
+
+  @staticmethod
+  def collate_batch(batch):
+    # batches from `getbatch` are ready to use
+    return batch
+
+  @staticmethod
+  def collate_trimmed(batch, collate_fn = torch.utils.data.dataloader.default_collate):
+    '''
+    Collate the batch with `collate_fn` and cut the padded sequences (sentence and position
+    channels) to the longest sentence of the batch instead of `maxseqlen`.
+    '''
+    batch = collate_fn(batch)
+    maxlen = int(batch[3].max())
+    for i in [ 2, 4, 5 ]:
+      batch[i] = batch[i][:, :maxlen]
+    return batch
   
   def cpu(self):
     return self.to(torch.device('cpu'))
@@ -272,6 +599,7 @@ class SemEval2010(torch.utils.data.Dataset):
   maxseqlen: {self.maxseqlen:d}
   maxentlen: {self.maxentlen:d}
   maxdist: {self.maxdist:d}
+  memory: {self.nbytes() / 2**20:.2f} MB (saved {(self.nbytes_long - self.nbytes()) / 2**20:.2f} MB by compact storage)
   wordindex: {self.index}
   posiindex: {self.posiindex}
   classindex: {self.classindex}
@@ -279,7 +607,7 @@ class SemEval2010(torch.utils.data.Dataset):
   dclassindex: {self.dclassindex}
   eclassindex: {self.eclassindex}
   device: {self.device}
-  sample[0]: {self.samples.iloc[0].seq_recon}
+  sample[0]: {self.index.decode_batch(self.tensors.seq[0])}
 )  
 '''
   
@@ -288,17 +616,80 @@ class SemEval2010(torch.utils.data.Dataset):
 '''
 class FixedLengthSequenceDataset(torch.utils.data.Dataset):
 
-  def __init__(self, seqlen = 35, skip = 35):
+  CACHE_VERSION = 2
+  __getitems__ = None # the DataLoader only fetches whole batches if this is set, see `batched()`
+
+  def __init__(self, seqlen = 35, skip = 35, cache = False, compact = False):
     super(FixedLengthSequenceDataset, self)
     self.seqlen = seqlen
     self.skip = skip
+    self.cache = cache
+    self.compact = compact
     self.data = None
     self.nsequences = None
+
+  @staticmethod
+  def filehash(fname, blocksize = 1 << 20, size = None):
+    # hash over the content of the file, or only over its first `size` bytes
+    h = hashlib.sha1()
+    remaining = size if size is not None else float('inf')
+    with open(fname, 'rb') as f:
+      for block in iter(lambda: f.read(int(min(blocksize, remaining))), b''):
+        h.update(block)
+        remaining -= len(block)
+    return h.hexdigest()
+
+  def load_cached(self, mode, encode):
+    '''
+    Return the encoded sequence of `self.file` from the cache or produce it with `encode()`
+    and store it. A cache entry consists of the flat token ids (`.bin`) and the index after
+    encoding including the counts (`.vocab`, binary format). It is keyed by the content of the source file,
+    the state of the index before encoding and the tokenization `mode`, cached data
+    is memory mapped. With `self.compact` ids are stored in the smallest type
+    which fits the index (see `compactIntType`).
+    '''
+    if not self.cache:
+      return self.compacted(encode())
+    key = hashlib.sha1(repr((self.CACHE_VERSION, self.filehash(self.file), self.index.fingerprint(), mode, self.compact)).encode('utf8')).hexdigest()
+    cachefile = f'{self.file:s}.{mode:s}-{key[:16]:s}'
+    if os.path.isfile(cachefile + '.bin') and os.path.isfile(cachefile + '.vocab'):
+      print('Loading cached %s from %s' % (mode, cachefile), file=sys.stderr)
+      vocab = Index.fromfile(cachefile + '.vocab')
+      for w in vocab.id2w[len(self.index):]:
+        self.index.add(w)
+      if not self.index.frozen:
+        self.index.counts = collections.Counter({ i: int(c) for i, c in enumerate(vocab.counts) if c > 0 })
+      dtype = torch.empty(0, dtype=self.datatype()).numpy().dtype
+      if os.path.getsize(cachefile + '.bin') == 0:
+        return torch.empty(0, dtype=self.datatype())
+      return torch.from_numpy(np.memmap(cachefile + '.bin', dtype=dtype, mode='c'))
+    data = self.compacted(encode())
+    data.numpy().tofile(cachefile + '.bin.tmp')
+    self.index.tofile(cachefile + '.vocab.tmp', binary = True)
+    os.replace(cachefile + '.bin.tmp', cachefile + '.bin')
+    os.replace(cachefile + '.vocab.tmp', cachefile + '.vocab')
+    return data
     
+  def datatype(self):
+    return compactIntType(len(self.index)) if self.compact else torch.int64
+
+  def compacted(self, data):
+    return data.to(self.datatype())
+
+  def remap(self, mapping):
+    # apply an id mapping, e.g. from `Index.prune`, to the data
+    self.data = self.compacted(torch.as_tensor(mapping)[self.data.long()])
+    self.nsequences = None
+    return self
+
   def __len__(self):
     if self.nsequences is None:
       self.nsequences = int(math.ceil((len(self.data)-self.seqlen) / self.skip))
     return self.nsequences
+
+  def __repr__(self):
+    nbytes = tensorBytes(self.data)
+    return f'{self.__class__.__name__:s} (ntokens: {self.data.numel():d}, dtype: {self.data.dtype}, memory: {nbytes / 2**20:.2f} MB, saved {(self.data.numel() * 8 - nbytes) / 2**20:.2f} MB by compact storage)'
     
   def __getitem__(self, index):
     # seqlen=4
@@ -331,6 +722,41 @@ class FixedLengthSequenceDataset(torch.utils.data.Dataset):
     x = self.data[skip_index     : skip_index + self.seqlen    ]
     y = self.data[skip_index + 1 : skip_index + self.seqlen + 1]
     return x, y, self.seqlen
+
+  def getbatch(self, indices):
+    '''
+    Fetch the sequences for all `indices` at once, returns `[x, y, seqlengths]` with x and y
+    in time-major layout (seqlen x batch). If the sequences are evenly spaced, which is the
+    case for `EvenlyDistributingSampler`, x and y are strided views on the data without any
+    copy, otherwise the windows are gathered with a single indexing operation.
+    '''
+    indices = torch.as_tensor(indices, dtype=torch.long)
+    starts = indices * self.skip
+    steps = starts[1:] - starts[:-1]
+    seqlengths = torch.full((len(indices),), self.seqlen, dtype=torch.long)
+    if len(steps) == 0 or (steps[0] > 0 and bool((steps == steps[0]).all())):
+      step = int(steps[0]) if len(steps) > 0 else 1
+      stride = self.data.stride(0)
+      offset = self.data.storage_offset() + int(starts[0]) * stride
+      x = self.data.as_strided((self.seqlen, len(indices)), (stride, step * stride), offset)
+      y = self.data.as_strided((self.seqlen, len(indices)), (stride, step * stride), offset + stride)
+      return [ x, y, seqlengths ]
+    x = self.data[:-1].unfold(0, self.seqlen, self.skip)[indices].t()
+    y = self.data[1:].unfold(0, self.seqlen, self.skip)[indices].t()
+    return [ x, y, seqlengths ]
+
+  def batched(self, batched = True):
+    '''
+    Let the DataLoader fetch whole batches with `getbatch` instead of single items,
+    use it together with `collate_fn = FixedLengthSequenceDataset.collate_batch`.
+    '''
+    self.__getitems__ = self.getbatch if batched else None
+    return self
+
+  @staticmethod
+  def collate_batch(batch):
+    # batches from `getbatch` are ready to use
+    return batch
   
   def cuda(self):
     self.data = self.data.cuda()
@@ -346,14 +772,17 @@ class CharSequence(FixedLengthSequenceDataset):
   def load(self):
     print('Loading chars from %s' % self.file, file=sys.stderr)    
     assert os.path.exists(self.file)    
+    return self.load_cached('chars', self.encode)
+
+  def encode(self):
     with open(self.file, 'r', encoding='utf8') as f:
       charsequence = f.read()
-    sequence = torch.LongTensor(list(map(lambda c: self.index.add(c.strip()), charsequence)))
+    sequence, _ = self.index.encode_batch([ [ c.strip() for c in charsequence ] ])
     del charsequence
-    return sequence
+    return torch.from_numpy(sequence)
     
-  def __init__(self, path, subset = 'train.txt', index = None, seqlen = 35, skip = 35):
-    super(CharSequence, self).__init__(seqlen, skip)
+  def __init__(self, path, subset = 'train.txt', index = None, seqlen = 35, skip = 35, cache = False, compact = False):
+    super(CharSequence, self).__init__(seqlen, skip, cache, compact)
     self.path = path
     self.subset = subset
     self.file = os.path.join(self.path, self.subset)
@@ -369,46 +798,298 @@ class TokenSequence(FixedLengthSequenceDataset):
   def load(self):
     print('Loading %s sentences from %s' % (self.subset, self.file), file=sys.stderr)    
     assert os.path.exists(self.file)    
-    data_ = []
+    return self.load_cached('tokens', self.encode)
+
+  def encode(self):
+    if self.nworkers > 1:
+      return self.encode_parallel()
     with open(self.file, 'r', encoding='utf8') as f:
-      for i, line in enumerate(f):
-        for w in line.split() + ['<eos>']:
-          data_.append(self.index.add(w.strip()))
-    data = torch.LongTensor(data_)
-    del data_
-    return data
+      data, _ = self.index.encode_batch([ line.split() + ['<eos>'] for line in f ])
+    return torch.from_numpy(data)
+
+  @staticmethod
+  def encode_chunk(chunk):
+    '''
+    Encode the lines in the byte range `chunk = (file, begin, end)` with a local index,
+    returns the local ids and the local vocabulary in order of first appearance.
+    '''
+    fname, begin, end = chunk
+    with open(fname, 'rb') as f:
+      f.seek(begin)
+      text = f.read(end - begin).decode('utf8')
+    localindex = Index()
+    ids, _ = localindex.encode_batch([ line.split() + ['<eos>'] for line in io.StringIO(text, newline=None) ])
+    return ids, localindex.vocabulary(), [ localindex.getCount(i) for i in range(len(localindex)) ]
+
+  def chunks(self, nchunks):
+    # split the file into byte ranges which end on line boundaries
+    size = os.path.getsize(self.file)
+    bounds = [ 0 ]
+    with open(self.file, 'rb') as f:
+      for i in range(1, nchunks):
+        f.seek(max(bounds[-1], (size * i) // nchunks))
+        f.readline()
+        if f.tell() > bounds[-1] and f.tell() < size:
+          bounds.append(f.tell())
+    bounds.append(size)
+    return [ (self.file, b, e) for b, e in zip(bounds[:-1], bounds[1:]) ]
+
+  def encode_parallel(self):
+    '''
+    Encode chunks of the file in `nworkers` processes. The local vocabularies are merged
+    into `self.index` in chunk order, which hands out exactly the same ids as the
+    sequential path (including unknown mapping for a frozen index).
+    '''
+    data = []
+    with multiprocessing.Pool(self.nworkers) as pool:
+      for ids, vocab, counts in pool.imap(TokenSequence.encode_chunk, self.chunks(self.nworkers * 4)):
+        mapping = self.index.merge(vocab, counts)
+        data.append(mapping[ids])
+    return torch.from_numpy(np.concatenate(data)) if data else torch.LongTensor()
     
-  def __init__(self, path, subset = 'train.txt', index = None, seqlen = 35, skip = 35):
-    super(TokenSequence, self).__init__(seqlen, skip)
+  def __init__(self, path, subset = 'train.txt', index = None, seqlen = 35, skip = 35, cache = False, compact = False, nworkers = 1):
+    super(TokenSequence, self).__init__(seqlen, skip, cache, compact)
     self.path = path
     self.subset = subset
     self.file = os.path.join(self.path, self.subset)
     self.index = index if index is not None else Index()
+    self.nworkers = nworkers
     self.data = self.load()
 
 
-class SpamDataset(torch.utils.data.Dataset):
+'''
+ bptt batches over the columns of a single 1d tensor, like `batchify` and `get_batch` in examples/rnnlm_original.py
+'''
+class BPTTIterator(object):
+
+  def __init__(self, data, batch_size, bptt = 35, variable = False, seed = 10101, num_replicas = 1, rank = 0):
+    '''
+    Arrange `data` once into `batch_size` columns (nsteps x batch_size) and iterate over
+    chunks of `bptt` steps as `[x, y, seqlengths]`, x and y are time-major views into the
+    columns. The last chunk of an epoch is shorter if the columns are not a multiple of `bptt`.
+    With `variable`, the chunk lengths are drawn around `bptt` (sometimes `bptt/2`) for every
+    epoch, as in AWD-LSTM, so that not always the same tokens start a chunk. For data parallel
+    training `data` is arranged into `num_replicas * batch_size` columns of which process
+    `rank` keeps its `batch_size` (contiguous) columns, as in `utils.EvenlyDistributingSampler`.
+    '''
+    nsteps = data.size(0) // (batch_size * num_replicas)
+    self.data = data.narrow(0, rank * nsteps * batch_size, nsteps * batch_size).view(batch_size, -1).t().contiguous()
+    self.batch_size = batch_size
+    self.bptt = bptt
+    self.variable = variable
+    self.seed = seed
+    self.numitercalls = -1
+    self.chunks = None
+    self.current = None
+
+  def chunklengths(self, epoch):
+    nsteps = self.data.size(0) - 1
+    if not self.variable:
+      return [ min(self.bptt, nsteps - i) for i in range(0, nsteps, self.bptt) ]
+    rng = np.random.RandomState(self.seed + epoch)
+    lengths = []
+    i = 0
+    while i < nsteps:
+      bptt = self.bptt if rng.random_sample() < 0.95 else self.bptt / 2.
+      l = min(max(5, int(rng.normal(bptt, 5))), nsteps - i)
+      lengths.append(l)
+      i += l
+    return lengths
+
+  def __len__(self):
+    # during an epoch its own number of chunks, otherwise the one of the next epoch
+    if self.current is not None:
+      return len(self.current)
+    if self.chunks is None:
+      self.chunks = self.chunklengths(self.numitercalls + 1)
+    return len(self.chunks)
+
+  def __iter__(self):
+    self.numitercalls += 1
+    chunks = self.chunks if self.chunks is not None else self.chunklengths(self.numitercalls)
+    self.chunks = None
+    self.current = chunks
+    try:
+      i = 0
+      for l in chunks:
+        x = self.data.narrow(0, i, l)
+        y = self.data.narrow(0, i + 1, l)
+        yield [ x, y, torch.full((self.batch_size,), l, dtype=torch.long) ]
+        i += l
+    finally:
+      self.current = None
+
+'''
+ tokens as a sequence spread over several binary shard files, for corpora which do not fit into memory
+'''
+class ShardedSequenceDataset(FixedLengthSequenceDataset):
+
+  def __init__(self, shards, seqlen = 35, skip = 35, maxopenshards = 2, dtype = np.int64):
+    super(ShardedSequenceDataset, self).__init__(seqlen, skip)
+    self.shards = list(shards)
+    self.dtype = np.dtype(dtype)
+    self.maxopenshards = max(1, maxopenshards)
+    shardlengths = [ os.path.getsize(f) // self.dtype.itemsize for f in self.shards ]
+    self.shardoffsets = np.zeros(len(self.shards) + 1, dtype=np.int64)
+    np.cumsum(shardlengths, out=self.shardoffsets[1:])
+    self.openshards = collections.OrderedDict() # lru cache of memory mapped shards
+    self.device = torch.device('cpu')
+
+  @staticmethod
+  def write_shards(fname, index, prefix, shardsize = 1 << 26, dtype = np.int64, blocklines = 100000):
+    '''
+    Encode the text file `fname` like `TokenSequence` block by block and write the
+    ids into shards `{prefix}.{i}.bin` of at most `shardsize` tokens each.
+    '''
+    shards = []
+    out = None
+    written = shardsize
+    with open(fname, 'r', encoding='utf8') as f:
+      for lines in iter(lambda: list(itertools.islice(f, blocklines)), []):
+        ids, _ = index.encode_batch([ line.split() + ['<eos>'] for line in lines ], dtype=dtype)
+        pos = 0
+        while pos < len(ids):
+          if written >= shardsize:
+            if out is not None:
+              out.close()
+            shards.append(f'{prefix:s}.{len(shards):05d}.bin')
+            out = open(shards[-1], 'wb')
+            written = 0
+          n = min(shardsize - written, len(ids) - pos)
+          out.write(ids[pos:pos+n].tobytes())
+          written += n
+          pos += n
+    if out is not None:
+      out.close()
+    return shards
+
+  def ntokens(self):
+    return int(self.shardoffsets[-1])
+
+  def __repr__(self):
+    return f'{self.__class__.__name__:s} (nshards: {len(self.shards):d}, ntokens: {self.ntokens():d}, dtype: {self.dtype}, open shards: {len(self.openshards):d} / {self.maxopenshards:d})'
+
+  def __len__(self):
+    if self.nsequences is None:
+      self.nsequences = int(math.ceil((self.ntokens()-self.seqlen) / self.skip))
+    return self.nsequences
+
+  def shard(self, i):
+    if i in self.openshards:
+      self.openshards.move_to_end(i)
+      return self.openshards[i]
+    while len(self.openshards) >= self.maxopenshards:
+      _, m = self.openshards.popitem(last=False)
+      del m
+    if self.shardoffsets[i+1] == self.shardoffsets[i]:
+      m = np.empty(0, dtype=self.dtype) # empty files can not be memory mapped
+    else:
+      m = np.memmap(self.shards[i], dtype=self.dtype, mode='r')
+    self.openshards[i] = m
+    return m
+
+  def slice(self, begin, end):
+    # copy tokens [begin, end) out of the shards, the range may span several shards
+    end = min(end, self.ntokens())
+    i = int(np.searchsorted(self.shardoffsets, begin, side='right')) - 1
+    parts = []
+    while begin < end:
+      offset = self.shardoffsets[i]
+      e = min(end, self.shardoffsets[i+1])
+      parts.append(self.shard(i)[begin-offset:e-offset])
+      begin = e
+      i += 1
+    return torch.from_numpy(np.concatenate(parts).astype(np.int64)) if parts else torch.LongTensor()
+
+  def __getitem__(self, index):
+    # same windows as `FixedLengthSequenceDataset`, but read x and y in one go
+    skip_index = index * self.skip
+    xy = self.slice(skip_index, skip_index + self.seqlen + 1).to(self.device)
+    return xy[:self.seqlen], xy[1:], self.seqlen
+
+  def getbatch(self, indices):
+    # shards are not contiguous in memory, stack the single windows instead
+    x, y, seqlengths = torch.utils.data.dataloader.default_collate([ self[i] for i in indices ])
+    return [ x.t(), y.t(), seqlengths ]
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['openshards'] = collections.OrderedDict()
+    return state
+
+  def cuda(self):
+    return self.to(torch.device('cuda'))
+
+  def to(self, device):
+    self.device = device
+    return self
+
+
+class TokenIdDataset(torch.utils.data.Dataset):
+  '''
+  Base for datasets of token lists, which are stored once as a padded (nsamples x maxlength) int32
+  id matrix plus the lengths and the pre-encoded labels. Items are
+  `(ids, length, label, onehot_label, index)`, word vectors are produced for whole batches:
+
+    emb = dataset.embedding(embedding.FastTextEmbedding('wiki.en.bin').load())
+    for ids, lengths, labels, oh_labels, indices in torch.utils.data.DataLoader(dataset, batch_size = 50):
+      vectors = emb(ids.long()) # batch_size x maxlength x dim
+  '''
+  def __init__(self, maxlength = 30, index = None):
+    super(TokenIdDataset, self).__init__()
+    self.maxlength = maxlength
+    self.index = index if index is not None else Index(initwords = ['<pad>', '<unk>'], unkindex = 1)
+    self.padidx = self.index.add('<pad>')
+
+  def make_tensors(self, samples, labelids, nclasses):
+    ids, offsets = self.index.encode_batch(samples, dtype = np.int32)
+    lengths = np.diff(offsets)
+    rows = np.repeat(np.arange(len(samples)), lengths)
+    cols = np.arange(len(ids)) - offsets[:-1][rows]
+    m = cols < self.maxlength
+    seq = np.full((len(samples), self.maxlength), self.padidx, dtype=np.int32)
+    seq[rows[m], cols[m]] = ids[m]
+    self.seq = torch.from_numpy(seq)
+    self.seqlen = torch.from_numpy(np.minimum(lengths, self.maxlength))
+    self.labelids = torch.as_tensor(labelids, dtype=torch.long)
+    self.oh_labels = torch.eye(nclasses, dtype=torch.long)[self.labelids]
+
+  def embedding(self, emb):
+    '''
+    Frozen `torch.nn.Embedding` with the vectors of `emb` (an `embedding.Embedding`) for the words
+    of the index, padding and words unknown to `emb` get zero vectors.
+    '''
+    weights = np.zeros((len(self.index), emb.dim()), dtype=np.float32)
+    for i, w in enumerate(self.index.id2w):
+      if i != self.padidx and emb.containsWord(w):
+        weights[i] = emb.getVector(w)
+    return torch.nn.Embedding.from_pretrained(torch.from_numpy(weights), freeze = True, padding_idx = self.padidx)
+
+  def __len__(self):
+    return self.seq.size(0)
+
+  def __getitem__(self, index):
+    return self.seq[index], self.seqlen[index], self.labelids[index], self.oh_labels[index], index
+
+
+class SpamDataset(TokenIdDataset):
 
     '''
     maxlength = size of padding
     '''
-    def __init__(self, maxlength = 30, subset='all'):
-      super(SpamDataset, self)
-      self.maxlength = maxlength
+    def __init__(self, maxlength = 30, subset='all', index = None, nlp_batch_size=1000, nlp_processes=1):
+      super(SpamDataset, self).__init__(maxlength, index)
       self.subset = subset
+      self.nlp_batch_size = nlp_batch_size
+      self.nlp_processes = nlp_processes
       self.samples, self.labels = self.load_data()
-      self.samples_vectors = self.load_samples_vectors()
+      self.make_tensors(self.samples, self.labels, len(self.classes))
 
     def load_data(self):
       # do some preprocessing if preprocessed file does not exist
-      if not os.path.isfile('SMSSpamCollection_normalized.pkl'):
-        #import spacy; nlp=spacy.load('en')
-        print('Applying spacy.')
-        import en_core_web_sm
-        nlp = en_core_web_sm.load()
+      if not os.path.isfile('SMSSpamCollection_normalized'):
 
-        def normalize(message):
-          doc = nlp(message)
+        def normalize(doc):
           normalized = doc
           normalized = filter(lambda t : t.is_alpha and not t.is_stop, doc)
           normalized = map(lambda t : t.text, normalized)
@@ -421,8 +1102,10 @@ class SpamDataset(torch.utils.data.Dataset):
             quoting=csv.QUOTE_NONE,
             names=['label', 'message'],
             encoding='UTF-8')
-        messages['normalized'] = messages.message.apply(normalize)
+        # only lexical attributes are needed, so the tokenizer is enough
+        messages['normalized'] = annotate(messages.message.tolist(), 'SMSSpamCollection_normalized', transform = normalize, batch_size = self.nlp_batch_size, n_process = self.nlp_processes)
         messages.to_pickle('SMSSpamCollection_normalized')
+        remove_annotations('SMSSpamCollection_normalized')
 
       # load normalized messages
       messages = pandas.read_pickle('SMSSpamCollection_normalized')
@@ -445,170 +1128,129 @@ class SpamDataset(torch.utils.data.Dataset):
         labels = labels[:cut_off]
       return samples, labels
 
-    def __len__(self):
-      return len(self.samples)
 
-    """Returns (item as matrix of token vectors, label, index) instead of the normal (item, label). See constructor for more info"""
-    def __getitem__(self, index):
-      msg = self.samples[index]
-      int_label = self.classes[self.labels[index]]   #Convert label to integer. Is this slow?
-      #mat = np.zeros( (self.maxlength, self.ftmodel.numpy_normalized_vectors.shape[1]) )
-      mat = np.zeros( (self.maxlength, 300) )   #Hard coded for the wikipedia data that has dim=300
-
-      for i, token in enumerate(msg):
-        if i >= self.maxlength:
-          break
-        v = emb.getVector(token)
-        mat[i,:] = v
-        oh_label = self.oh_classes.transform([[self.labels[index]]])
-        oh_label = oh_label[0]
-        #print(oh_label)
-
-      return ( torch.tensor(mat), int_label, oh_label, index )
-
-#    def get_sample(self, index):
-#        return self.samples[index]
-
-
-#    def load_samples_vectors(self):
-#        #Average Word_count train: 94
-#        #Average Word_count test: 88.2
-#        # av_len = 0
-#        # for msg in self.samples:
-#        #     av_len+= len(msg)
-#        # print(av_len / len(self.samples))
-#        #print(len(self.samples))
-#
-#        mat = np.zeros( (len(self.samples),self.maxlength, 300) )
-#        # filter unknowns
-#        for j, msg in enumerate(self.samples):
-#          for i, token in enumerate(msg):
-#            word = self.samples[j][i]
-#            if not emb.containsWord(word):
-#              self.samples[j].remove(word)
-#            if emb.containsWord(word) and not emb.containsWord(token):
-#              print(word, token, " DAFUQ")
-#
-#        for j, msg in enumerate(self.samples):
-#          #print(msg)
-#          for i, token in enumerate(msg):
-#            if i >= self.maxlength:
-#              break
-#            if not emb.containsWord(token):
-#              #print(token)
-#              continue
-#            v = emb.getVector(token)
-#            #print(v)
-#            mat[j, i, :] = v
-#        return mat
-
-
-class NewsGroupDataset(torch.utils.data.Dataset):
+class NewsGroupDataset(TokenIdDataset):
 
     '''
     maxlength = size of padding
     '''
-    def __init__(self, subset='all',  maxlength = 30):
-      super(NewsGroupDataset, self)
-      self.maxlength = maxlength
+    CACHE_MAGIC = b'\x00NGC'
+    CACHE_VERSION = 1
+    CACHE_HEADER = '<4sIQ' # magic, version, length of the json description which follows
+
+    def __init__(self, subset='all',  maxlength = 30, index = None, nlp_batch_size=1000, nlp_processes=1):
+      super(NewsGroupDataset, self).__init__(maxlength, index)
       self.subset = subset
+      self.nlp_batch_size = nlp_batch_size
+      self.nlp_processes = nlp_processes
       self.file_name = "20_newsgroup_normalized_" + subset
-      self.samples, self.labels = self.load_data()
-      self.samples_vectors = self.load_samples_vectors()
+      self.load()
 
+    @staticmethod
+    def normalize(doc):
+      normalized = doc
+      normalized = filter(lambda t : t.is_alpha and not t.is_stop, doc)
+      normalized = map(lambda t : t.text, normalized)
+      normalized = list(normalized)
+      return normalized
 
-    def load_data(self):
-      messages = fetch_20newsgroups(subset=self.subset, remove=('headers','footers','quotes'), shuffle=True, random_state=42)
-      # do some preprocessing if preprocessed file does not exist
-      if not os.path.isfile(self.file_name):
-        #import spacy; nlp=spacy.load('en')
-        print('Applying spacy.')
-        import en_core_web_sm
-        nlp = en_core_web_sm.load()
+    def cachefile(self):
+      # the cache depends on the subset, the padding and the state of the index before loading
+      key = hashlib.sha1(repr((self.CACHE_VERSION, self.subset, self.maxlength, self.index.fingerprint())).encode('utf8')).hexdigest()
+      return f'{self.file_name:s}.{key[:16]:s}.cache'
 
-        def normalize(message):
-          doc = nlp(message)
-          normalized = doc
-          normalized = filter(lambda t : t.is_alpha and not t.is_stop, doc)
-          normalized = map(lambda t : t.text, normalized)
-          normalized = list(normalized)
-          return normalized
+    def load(self):
+      cachefile = self.cachefile()
+      if os.path.isfile(cachefile):
+        return self.load_cached(cachefile)
 
-        messages_normalized = list(map(normalize, messages.data))
-        with open(self.file_name, 'wb') as f:
-          pickle.dump(messages_normalized, f)
+      messages = fetch_20newsgroups(subset=self.subset, remove=('headers','footers','quotes'), shuffle=True, random_state=42)
+      # only lexical attributes are needed, so the tokenizer is enough
+      samples = annotate(messages.data, self.file_name, transform = self.normalize, batch_size = self.nlp_batch_size, n_process = self.nlp_processes)
+      nwords = len(self.index)
+      self.set_classes(sorted(set(messages.target.tolist())), list(messages.target_names))
+      self.labels = np.asarray(messages.target, dtype=np.int64)
+      self.make_tensors(samples, [ self.classes[l] for l in self.labels.tolist() ], len(self.classes))
 
-      with open(self.file_name, 'rb') as f:
-        messages_normalized = pickle.load(f)
+      # tokens as one utf-8 blob
+      words = [ w.encode('utf8') for sample in samples for w in sample ]
+      self.tokens = np.frombuffer(b''.join(words), dtype=np.uint8)
+      self.tokenoffsets = np.zeros(len(words) + 1, dtype=np.int64)
+      np.cumsum(np.fromiter(map(len, words), dtype=np.int64, count=len(words)), out=self.tokenoffsets[1:])
+      self.sampleoffsets = np.zeros(len(samples) + 1, dtype=np.int64)
+      np.cumsum(np.fromiter(map(len, samples), dtype=np.int64, count=len(samples)), out=self.sampleoffsets[1:])
 
-      samples = messages_normalized
-      labels = messages.target
+      self.save_cached(cachefile, nwords)
+      remove_annotations(self.file_name)
+      return self
 
-      self.classes = list(set(labels))
-      self.classes.sort()   #Otherwise it is inconsistent which class is 0 and which is 1
+    def set_classes(self, classes, target_names):
+      self.target_names = target_names
       self.oh_classes = MultiLabelBinarizer()
-      self.oh_classes.fit([[label] for label in self.classes])
+      self.oh_classes.fit([[label] for label in classes])
       self.classes = dict([(l,i) for (i,l) in enumerate(self.oh_classes.classes_)])
 
-      return samples, labels
+    def arrays(self):
+      return dict(seq = self.seq.numpy(), seqlen = self.seqlen.numpy(), labelids = self.labelids.numpy(), labels = self.labels,
+                  tokens = self.tokens, tokenoffsets = self.tokenoffsets, sampleoffsets = self.sampleoffsets,
+                  counts = np.array([ self.index.getCount(i) for i in range(len(self.index)) ], dtype=np.int64))
 
-    def __len__(self):
-      return len(self.samples)
-
-    """Returns (item as matrix of token vectors, label, index) instead of the normal (item, label). See constructor for more info"""
-    def __getitem__(self, index):
-      msg = self.samples[index]
-      label = self.classes[self.labels[index]]   #Convert label to integer. Is this slow?
-      oh_label = self.oh_classes.transform([[self.labels[index]]])
-      oh_label = oh_label[0]
-      #mat = np.zeros( (self.maxlength, self.ftmodel.numpy_normalized_vectors.shape[1]) )
-      mat = np.zeros( (self.maxlength, 300) )   #Hard coded for the wikipedia data that has dim=300
+    def save_cached(self, cachefile, nwords):
+      '''
+      Write everything into a single file: header | json description | arrays (64 byte aligned).
+      The description holds the class mapping, the words which were added to the index and
+      dtype, shape and position of every array.
+      '''
+      arrays = self.arrays()
+      layout = {}
+      offset = 0
+      for name, a in arrays.items():
+        layout[name] = (a.dtype.str, a.shape, offset)
+        offset += (a.nbytes + 63) // 64 * 64
+      meta = json.dumps(dict(classes = [ int(c) for c in self.classes ], target_names = self.target_names, words = self.index.id2w[nwords:], arrays = layout)).encode('utf8')
+      start = (struct.calcsize(self.CACHE_HEADER) + len(meta) + 63) // 64 * 64
+      with open(cachefile + '.tmp', 'wb') as f:
+        f.write(struct.pack(self.CACHE_HEADER, self.CACHE_MAGIC, self.CACHE_VERSION, len(meta)))
+        f.write(meta)
+        for name, a in arrays.items():
+          f.seek(start + layout[name][2])
+          f.write(np.ascontiguousarray(a).tobytes())
+        f.truncate(start + offset)
+      os.replace(cachefile + '.tmp', cachefile)
 
-
-      for i, token in enumerate(msg):
-        if i >= self.maxlength:
-          break
-        if not emb.containsWord(token):
-          continue
-        v = emb.getVector(token)
-        mat[i,:] = v
-
-      return ( torch.tensor(mat), label, oh_label,  index )
+    def load_cached(self, cachefile):
+      print(f'Loading cached {self.subset:s} from {cachefile:s}', file=sys.stderr)
+      with open(cachefile, 'rb') as f:
+        magic, version, metalength = struct.unpack(self.CACHE_HEADER, f.read(struct.calcsize(self.CACHE_HEADER)))
+        if magic != self.CACHE_MAGIC or version != self.CACHE_VERSION:
+          raise ValueError(f'{cachefile:s} is not a newsgroup cache of version {self.CACHE_VERSION:d}.')
+        meta = json.loads(f.read(metalength).decode('utf8'))
+      start = (struct.calcsize(self.CACHE_HEADER) + metalength + 63) // 64 * 64
+      arrays = {}
+      for name, (dtype, shape, offset) in meta['arrays'].items():
+        if np.prod(shape) == 0:
+          arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+          arrays[name] = np.memmap(cachefile, dtype=dtype, mode='c', offset=start + offset, shape=tuple(shape))
+      for w in meta['words']:
+        self.index.add(w)
+      if not self.index.frozen:
+        self.index.counts = collections.Counter({ i: int(c) for i, c in enumerate(arrays['counts']) if c > 0 })
+      self.set_classes(meta['classes'], meta['target_names'])
+      self.seq = torch.from_numpy(arrays['seq'])
+      self.seqlen = torch.from_numpy(arrays['seqlen'])
+      self.labelids = torch.from_numpy(arrays['labelids'])
+      self.oh_labels = torch.eye(len(self.classes), dtype=torch.long)[self.labelids]
+      self.labels, self.tokens, self.tokenoffsets, self.sampleoffsets = arrays['labels'], arrays['tokens'], arrays['tokenoffsets'], arrays['sampleoffsets']
+      return self
 
     def get_sample(self, index):
-        return self.samples[index]
-
-#    def load_samples_vectors(self):
-#        #Average Word_count train: 94
-#        #Average Word_count test: 88.2
-#        # av_len = 0
-#        # for msg in self.samples:
-#        #     av_len+= len(msg)
-#        # print(av_len / len(self.samples))
-#        #print(len(self.samples))
-#        mat = np.zeros( (len(self.samples),self.maxlength, 300) )
-#
-#        # filter unknowns
-#        for j, msg in enumerate(self.samples):
-#          for i, token in enumerate(msg):
-#            word = self.samples[j][i]
-#            if not emb.containsWord(word):
-#              self.samples[j].remove(word)
-#            if emb.containsWord(word) and not emb.containsWord(token):
-#              print(word, token, " DAFUQ")
-#
-#        for j, msg in enumerate(self.samples):
-#          #print(msg)
-#          for i, token in enumerate(msg):
-#            if i >= self.maxlength:
-#              break
-#            if not emb.containsWord(token):
-#              #print(token)
-#              continue
-#            v = emb.getVector(token)
-#            #print(v)
-#            mat[j, i, :] = v
-#        return mat
+      tokens, offsets = self.tokens, self.tokenoffsets
+      return [ tokens[offsets[i]:offsets[i+1]].tobytes().decode('utf8') for i in range(self.sampleoffsets[index], self.sampleoffsets[index+1]) ]
+
+    @property
+    def samples(self):
+      return [ self.get_sample(i) for i in range(len(self)) ]
 
 
 class DummyDataset(torch.utils.data.Dataset):
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+'''
+Compare dense one-hot / bag-of-words inputs (`utils.makeOneHot`, `utils.makeBow`) with token id
+inputs for `nets.rnn.RNN_CLASSIFY_linear`: time for forward and backward and size of the inputs.
+
+  python bow_benchmark.py --ntoken 50000 --batch-size 50 --seqlen 30
+'''
+
+import sys
+if not '..' in sys.path: sys.path.append('..')
+
+import argparse
+import time
+import torch
+
+import utils
+import nets.rnn
+
+def parseSystemArgs():
+  parser = argparse.ArgumentParser(description='Benchmark one-hot and bag-of-words inputs')
+  parser.add_argument('--ntoken', default=50000, type=int, help='size of the vocabulary')
+  parser.add_argument('--batch-size', default=50, type=int, help='batch size')
+  parser.add_argument('--seqlen', default=30, type=int, help='sequence length')
+  parser.add_argument('--nhid', default=200, type=int, help='size of hidden layer')
+  parser.add_argument('--repeat', default=10, type=int, help='number of batches to average over')
+  parser.add_argument('--cuda', action='store_true', help='use CUDA')
+  return parser.parse_args()
+
+def timeit(args, fun):
+  fun() # warm up
+  if args.cuda: torch.cuda.synchronize()
+  start_time = time.time()
+  for _ in range(args.repeat):
+    fun()
+  if args.cuda: torch.cuda.synchronize()
+  return (time.time() - start_time) * 1000 / args.repeat
+
+if __name__ == '__main__':
+  args = parseSystemArgs()
+  device = torch.device('cuda' if args.cuda else 'cpu')
+  model = nets.rnn.RNN_CLASSIFY_linear(args.ntoken, args.nhid, 10).to(device)
+  X = torch.randint(0, args.ntoken, (args.batch_size, args.seqlen), device=device)
+  targets = torch.randint(0, 10, (args.batch_size,), device=device)
+
+  def sequence(makeinputs):
+    def run():
+      model.zero_grad()
+      inputs = makeinputs()
+      hidden = model.init_hidden(args.batch_size)
+      for i in range(args.seqlen):
+        outputs, hidden = model(inputs[:, i] if inputs.dim() > 1 else inputs, hidden)
+      torch.nn.functional.nll_loss(outputs, targets).backward()
+    return run
+
+  def bow(makeinputs):
+    def run():
+      model.zero_grad()
+      outputs, _ = model(makeinputs(), model.init_hidden(args.batch_size))
+      torch.nn.functional.nll_loss(outputs, targets).backward()
+    return run
+
+  print(f'ntoken {args.ntoken:d}, batch size {args.batch_size:d}, seqlen {args.seqlen:d}, device {device}')
+  dense = utils.makeOneHot(X, args.ntoken)
+  print(f'one-hot sequence  dense:  {timeit(args, sequence(lambda: utils.makeOneHot(X, args.ntoken))):8.2f} ms/batch, input {utils.tensorBytes(dense) / 2**20:8.2f} MB')
+  print(f'one-hot sequence  ids:    {timeit(args, sequence(lambda: X)):8.2f} ms/batch, input {utils.tensorBytes(X) / 2**20:8.2f} MB')
+  del dense
+  print(f'bag-of-words      dense:  {timeit(args, bow(lambda: utils.makeBow(utils.makeOneHot(X, args.ntoken)))):8.2f} ms/batch, input {args.batch_size * args.ntoken * 4 / 2**20:8.2f} MB')
+  print(f'bag-of-words      sparse: {timeit(args, bow(lambda: utils.makeSparseBow(X, args.ntoken))):8.2f} ms/batch')
+  print(f'bag-of-words      ids:    {timeit(args, bow(lambda: X)):8.2f} ms/batch, input {utils.tensorBytes(X) / 2**20:8.2f} MB')
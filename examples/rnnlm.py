@@ -9,6 +9,7 @@ import argparse
 import time
 import math
 import os
+import functools
 from tqdm import tqdm
 import torch
 from torch.utils.data.sampler import BatchSampler, SequentialSampler, RandomSampler
@@ -16,7 +17,7 @@ from torch.utils.data.sampler import BatchSampler, SequentialSampler, RandomSamp
 import data
 import nets.rnn
 from embedding import Embedding, FastTextEmbedding, TextEmbedding, RandomEmbedding
-from utils import Index, ShufflingBatchSampler, EvenlyDistributingSampler, SimpleSGD, createWrappedOptimizerClass
+from utils import Index, ShufflingBatchSampler, EvenlyDistributingSampler, PrefetchingLoader, SimpleSGD, createWrappedOptimizerClass
 
 def parseSystemArgs():
   '''
@@ -67,7 +68,32 @@ def parseSystemArgs():
                       help='path to initial embedding. emsize must match size of embedding')
   parser.add_argument('--chars', action='store_true',
                       help='use character sequences instead of token sequences')
+  parser.add_argument('--cache', action='store_true',
+                      help='cache the encoded corpus next to the data files and memory map it in later runs')
+  parser.add_argument('--compact', action='store_true',
+                      help='store token ids in the smallest integer type that fits the vocabulary')
+  parser.add_argument('--min_count', type=int, default=1,
+                      help='remove tokens which occur less often in the training data from the vocabulary')
+  parser.add_argument('--max_vocab', type=int, default=0,
+                      help='keep only the most frequent tokens (0 = no limit)')
+  parser.add_argument('--batched', action='store_true',
+                      help='fetch whole batches as time-major views of the data instead of item by item')
+  parser.add_argument('--bptt_iterator', action='store_true',
+                      help='iterate over precomputed bptt chunks of the batchified corpus instead of using a DataLoader')
+  parser.add_argument('--variable_bptt', action='store_true',
+                      help='vary the bptt chunk length from epoch to epoch (only with --bptt_iterator)')
+  parser.add_argument('--prefetch', type=int, default=0,
+                      help='number of batches to prepare in a background thread (0 = no prefetching)')
+  parser.add_argument('--encode_workers', type=int, default=1,
+                      help='number of processes for encoding token sequences')
+  parser.add_argument('--distributed', action='store_true',
+                      help='train data parallel with torch.distributed (gloo), start with `torchrun --nproc_per_node N rnnlm.py --distributed ...`, --batch_size is per process, --cache files are written per node')
   args = parser.parse_args()
+
+  if args.distributed:
+    torch.distributed.init_process_group(backend = 'gloo')
+  setattr(args, 'rank', torch.distributed.get_rank() if args.distributed else 0)
+  setattr(args, 'world_size', torch.distributed.get_world_size() if args.distributed else 1)
   
   # Set the random seed manually for reproducibility.
   torch.manual_seed(args.seed)
@@ -85,13 +111,25 @@ def loadData(args):
   '''
   
   '''
-  __SequenceDataset = data.CharSequence if args.chars else data.TokenSequence
-  print(__SequenceDataset.__name__)
+  # the first process encodes (and caches) the corpus, the others wait and load it afterwards
+  if args.rank > 0:
+    torch.distributed.barrier()
+  __SequenceDataset = data.CharSequence if args.chars else functools.partial(data.TokenSequence, nworkers = args.encode_workers)
+  print(data.CharSequence.__name__ if args.chars else data.TokenSequence.__name__)
   index = Index(initwords = ['<unk>'], unkindex = 0)
-  train_ = __SequenceDataset(args.data, subset='train.txt', index = index, seqlen = args.bptt, skip = args.bptt).to(args.device)
-  index.freeze(silent = True).tofile(os.path.join(args.data, 'vocab_chars.txt' if args.chars else 'vocab_tokens.txt'))
-  test_ = __SequenceDataset(args.data, subset='test.txt', index = index, seqlen = args.bptt, skip = args.bptt).to(args.device)
-  valid_ = __SequenceDataset(args.data, subset='valid.txt', index = index, seqlen = args.bptt, skip = args.bptt).to(args.device)
+  train_ = __SequenceDataset(args.data, subset='train.txt', index = index, seqlen = args.bptt, skip = args.bptt, cache = args.cache, compact = args.compact).to(args.device)
+  if args.min_count > 1 or args.max_vocab > 0:
+    # prune the vocabulary and sort ids by frequency, '<eos>' is needed as sentence separator
+    ntypes = len(index)
+    train_.remap(index.prune(min_count = args.min_count, max_size = args.max_vocab or None, keep = ['<eos>']))
+    print('Pruned vocabulary from %d to %d types.' % (ntypes, len(index)))
+  index.freeze(silent = True)
+  if args.rank == 0:
+    index.tofile(os.path.join(args.data, 'vocab_chars.txt' if args.chars else 'vocab_tokens.txt'))
+  test_ = __SequenceDataset(args.data, subset='test.txt', index = index, seqlen = args.bptt, skip = args.bptt, cache = args.cache, compact = args.compact).to(args.device)
+  valid_ = __SequenceDataset(args.data, subset='valid.txt', index = index, seqlen = args.bptt, skip = args.bptt, cache = args.cache, compact = args.compact).to(args.device)
+  if args.distributed and args.rank == 0:
+    torch.distributed.barrier()
   
   # load pre embedding
   if args.init_weights:
@@ -113,13 +151,29 @@ def loadData(args):
   
   eval_batch_size = 10
   __ItemSampler = RandomSampler if args.shuffle_samples else SequentialSampler
-  __BatchSampler = BatchSampler if args.sequential_sampling else EvenlyDistributingSampler  
-  train_loader = torch.utils.data.DataLoader(train_, batch_sampler = ShufflingBatchSampler(__BatchSampler(__ItemSampler(train_), batch_size=args.batch_size, drop_last = True), shuffle = args.shuffle_batches, seed = args.seed), num_workers = 0)
-  test_loader = torch.utils.data.DataLoader(test_, batch_sampler = __BatchSampler(__ItemSampler(test_), batch_size=eval_batch_size, drop_last = True), num_workers = 0)
-  valid_loader = torch.utils.data.DataLoader(valid_, batch_sampler = __BatchSampler(__ItemSampler(valid_), batch_size=eval_batch_size, drop_last = True), num_workers = 0)
-  print(__ItemSampler.__name__)
-  print(__BatchSampler.__name__)
-  print('Shuffle training batches: ', args.shuffle_batches)
+  __BatchSampler = BatchSampler if args.sequential_sampling else functools.partial(EvenlyDistributingSampler, num_replicas = args.world_size, rank = args.rank)
+  if args.distributed and args.sequential_sampling:
+    raise ValueError('Sequential sampling cannot be distributed, every process needs its own columns.')
+  if args.bptt_iterator:
+    train_loader = data.BPTTIterator(train_.data, args.batch_size, bptt = args.bptt, variable = args.variable_bptt, seed = args.seed, num_replicas = args.world_size, rank = args.rank)
+    test_loader = data.BPTTIterator(test_.data, eval_batch_size, bptt = args.bptt, num_replicas = args.world_size, rank = args.rank)
+    valid_loader = data.BPTTIterator(valid_.data, eval_batch_size, bptt = args.bptt, num_replicas = args.world_size, rank = args.rank)
+    print(train_)
+    print(data.BPTTIterator.__name__)
+  else:
+    collate_fn = data.FixedLengthSequenceDataset.collate_batch if args.batched else None
+    train_loader = torch.utils.data.DataLoader(train_.batched(args.batched), batch_sampler = ShufflingBatchSampler(__BatchSampler(__ItemSampler(train_), batch_size=args.batch_size, drop_last = True), shuffle = args.shuffle_batches, seed = args.seed), collate_fn = collate_fn, num_workers = 0)
+    test_loader = torch.utils.data.DataLoader(test_.batched(args.batched), batch_sampler = __BatchSampler(__ItemSampler(test_), batch_size=eval_batch_size, drop_last = True), collate_fn = collate_fn, num_workers = 0)
+    valid_loader = torch.utils.data.DataLoader(valid_.batched(args.batched), batch_sampler = __BatchSampler(__ItemSampler(valid_), batch_size=eval_batch_size, drop_last = True), collate_fn = collate_fn, num_workers = 0)
+    print(train_)
+    print(__ItemSampler.__name__)
+    print(EvenlyDistributingSampler.__name__ if not args.sequential_sampling else BatchSampler.__name__)
+    print('Shuffle training batches: ', args.shuffle_batches)
+
+  if args.prefetch > 0:
+    train_loader = PrefetchingLoader(train_loader, nprefetch = args.prefetch, pin_memory = args.cuda)
+    test_loader = PrefetchingLoader(test_loader, nprefetch = args.prefetch, pin_memory = args.cuda)
+    valid_loader = PrefetchingLoader(valid_loader, nprefetch = args.prefetch, pin_memory = args.cuda)
 
   setattr(args, 'index', index)
   setattr(args, 'ntokens', len(index))
@@ -128,6 +182,7 @@ def loadData(args):
   setattr(args, 'validloader', valid_loader)
   setattr(args, 'preembweights', preemb_weights)
   setattr(args, 'eval_batch_size', eval_batch_size)
+  setattr(args, 'timemajor', args.batched or args.bptt_iterator)
 
   return args
 
@@ -148,11 +203,16 @@ def buildModel(args):
       train_em_weights = True).to(args.device)
   criterion = torch.nn.CrossEntropyLoss()
   optimizer = createWrappedOptimizerClass(SimpleSGD)(model.parameters(), lr =args.lr, clip = args.clip)
-  print(model)
-  print(criterion)
-  print(optimizer)
+  # gradients are averaged over the processes during backward (overlapping with computation),
+  # the parameters are broadcast from the first process at construction
+  parallel_model = torch.nn.parallel.DistributedDataParallel(model) if args.distributed else model
+  if args.rank == 0:
+    print(model)
+    print(criterion)
+    print(optimizer)
   
   setattr(args, 'model', model)
+  setattr(args, 'parallelmodel', parallel_model)
   setattr(args, 'criterion', criterion)
   setattr(args, 'optimizer', optimizer)
   
@@ -167,14 +227,17 @@ def getprocessfun(args):
   def process(batch_data):
     
     x_batch, y_batch, seqlengths, hidden, is_training = batch_data
-    # reshape x and y batches so seqlen is dim 0 and batch is dim 1
-    x_batch = x_batch.transpose(0,1) # switch dim 0 with dim 1
-    y_batch = y_batch.transpose(0,1).contiguous()
+    # reshape x and y batches so seqlen is dim 0 and batch is dim 1 (batched fetches and bptt chunks are already time-major), widen compact ids for the embedding
+    if not args.timemajor:
+      x_batch = x_batch.transpose(0,1) # switch dim 0 with dim 1
+      y_batch = y_batch.transpose(0,1)
+    x_batch = x_batch.long()
+    y_batch = y_batch.long().contiguous()
           
     hidden = model.repackage_hidden(hidden)
     if is_training:
       model.zero_grad()
-    outputs, hidden = model(x_batch, hidden, seqlengths)  
+    outputs, hidden = (args.parallelmodel if is_training else model)(x_batch, hidden, seqlengths)  
     outputs_flat = outputs.view(-1, args.ntokens)
     targets_flat = y_batch.view(-1)  
     loss = args.criterion(outputs_flat, targets_flat)
@@ -188,14 +251,20 @@ def evaluate(args, dloader):
   total_loss = 0.
   hidden = model.init_hidden(args.eval_batch_size)
   with torch.no_grad():
-    for batch, batch_data in enumerate(tqdm(dloader, ncols=89, desc = 'Test ')):   
+    for batch, batch_data in enumerate(tqdm(dloader, ncols=89, desc = 'Test ', disable = args.rank > 0)):   
       batch_data.append(hidden)
       batch_data.append(False)
       loss, (outputs_flat, hidden) = process(batch_data)    
       loss_ = loss.item()
       current_loss = args.eval_batch_size * loss_
       total_loss += current_loss
-  return total_loss / (len(dloader) * args.eval_batch_size )
+  nsamples = len(dloader) * args.eval_batch_size
+  if args.distributed:
+    # every process evaluated its own columns
+    t = torch.tensor([ total_loss, nsamples ], dtype = torch.float64)
+    torch.distributed.all_reduce(t)
+    total_loss, nsamples = t.tolist()
+  return total_loss / nsamples
 
 
 def train(args):
@@ -203,19 +272,21 @@ def train(args):
   # Turn on training mode which enables dropout.
   model.train()
   total_loss = 0.
-  start_time = time.time()
+  ntokens = 0
+  start_time = epoch_start_time = time.time()
   hidden = model.init_hidden(args.batch_size)
   
-  for batch, batch_data in enumerate(tqdm(args.trainloader, ncols=89, desc='train')):
+  for batch, batch_data in enumerate(tqdm(args.trainloader, ncols=89, desc='train', disable = args.rank > 0)):
+    ntokens += batch_data[0].numel()
     batch_data.append(hidden)
     batch_data.append(True)
     model.zero_grad()
-    loss, outputs_flat = process(batch_data)
+    loss, (outputs_flat, hidden) = process(batch_data)
     loss.backward()
     args.optimizer.step()
     total_loss += loss.item()
 
-    if batch % args.log_interval == 0 and batch > 0:
+    if batch % args.log_interval == 0 and batch > 0 and args.rank == 0:
       cur_loss = total_loss / args.log_interval
       elapsed = time.time() - start_time
       tqdm.write('| epoch {:3d} | batch {:5d} / {:5d} | lr {:02.2f} | ms/batch {:5.2f} | loss {:5.2f} | ppl {:8.2f}'.format(
@@ -229,6 +300,8 @@ def train(args):
           ))
       total_loss = 0
       start_time = time.time()
+  # all processes train on the same number of equally sized batches
+  setattr(args, 'tokenspersec', ntokens * args.world_size / (time.time() - epoch_start_time))
 
 if __name__ == '__main__':
   # Loop over epochs.
@@ -246,38 +319,53 @@ if __name__ == '__main__':
       epoch_start_time = time.time()
       train(args)
       val_loss = evaluate(args, args.validloader)
-      print('-' * 89)
-      print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | valid ppl {:8.2f}'.format(
-          epoch, 
-          (time.time() - epoch_start_time), 
-          val_loss, 
-          math.exp(val_loss)
-          ))
-      print('-' * 89)
-      # Save the model if the validation loss is the best we've seen so far.
+      if args.rank == 0:
+        print('-' * 89)
+        print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | valid ppl {:8.2f} | tokens/s {:8.0f}'.format(
+            epoch, 
+            (time.time() - epoch_start_time), 
+            val_loss, 
+            math.exp(val_loss),
+            args.tokenspersec
+            ))
+        if args.prefetch > 0:
+          print('| waited for data | train: {:5.2f}s | valid: {:5.2f}s'.format(args.trainloader.waittime, args.validloader.waittime))
+        print('-' * 89)
+      # Save the model if the validation loss is the best we've seen so far (the validation loss
+      # is averaged over all processes, so they all take the same decisions).
       if not best_val_loss or val_loss < best_val_loss:
-        with open(args.save, 'wb') as f:
-          torch.save(args.model, f)
+        if args.rank == 0:
+          with open(args.save, 'wb') as f:
+            torch.save(args.model, f)
         best_val_loss = val_loss
       else:
           # Anneal the learning rate if no improvement has been seen in the validation dataset.
           args.optimizer.adjustLearningRate(1. / 4.)     
 
   
-    # Load the best saved model.
-    with open(args.save, 'rb') as f:
-      model = torch.load(f)
-      # after load the rnn params are not a continuous chunk of memory
-      # this makes them a continuous chunk, and will speed up forward pass
-      model.rnn.flatten_parameters()
+    # Load the best saved model, only the first process wrote it (the other processes may run
+    # on other nodes), so it sends the parameters to the others.
+    state = [ None ]
+    if args.rank == 0:
+      with open(args.save, 'rb') as f:
+        state = [ torch.load(f).state_dict() ]
+    if args.distributed:
+      torch.distributed.broadcast_object_list(state, src = 0)
+    args.model.load_state_dict(state[0])
+    # after load the rnn params are not a continuous chunk of memory
+    # this makes them a continuous chunk, and will speed up forward pass
+    args.model.rnn.flatten_parameters()
     
     # Run on test data.
     #test_loss = evaluate(test_data)
     test_loss = evaluate(args, args.testloader)
-    print('=' * 89)
-    print('| End of training | test loss {:5.2f} | test ppl {:8.2f}'.format(
-        test_loss, math.exp(test_loss)))
-    print('=' * 89)
+    if args.rank == 0:
+      print('=' * 89)
+      print('| End of training | test loss {:5.2f} | test ppl {:8.2f}'.format(
+          test_loss, math.exp(test_loss)))
+      print('=' * 89)
+    if args.distributed:
+      torch.distributed.destroy_process_group()
 
   except KeyboardInterrupt:
     print('-' * 89)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+'''
+Compare the rule based tokenizer of `SemEval2010` with the spacy pipeline: time for preprocessing
+and encoding a subset from scratch, and agreement of the resulting sequences.
+
+  python semeval_tokenizers.py --data ../data/semeval2010 --subset train.txt
+'''
+
+import sys
+if not '..' in sys.path: sys.path.append('..')
+
+import argparse
+import collections
+import os
+import shutil
+import tempfile
+import time
+
+import data
+import utils
+
+def parseSystemArgs():
+  parser = argparse.ArgumentParser(description='Compare SemEval2010 tokenizers')
+  parser.add_argument('--data', default='../data/semeval2010', type=str, help='location of the data corpus')
+  parser.add_argument('--subset', default='train.txt', type=str, help='file to compare on')
+  parser.add_argument('--nlines', default=None, type=int, help='only use the first n lines')
+  parser.add_argument('--nlp-processes', default=1, type=int, help='number of processes for spacy')
+  return parser.parse_args()
+
+def load(args, tokenizer):
+  with tempfile.TemporaryDirectory() as path:
+    shutil.copy(os.path.join(args.data, args.subset), path)
+    start_time = time.time()
+    dataset = data.SemEval2010(path, subset = args.subset, nlines = args.nlines, index = utils.Index(initwords = ['<unk>'], unkindex = 0), cache = False, tokenizer = tokenizer, nlp_processes = args.nlp_processes)
+    return dataset, time.time() - start_time
+
+def sequences(dataset, col = 'seq', lencol = 'seqlen'):
+  t = dataset.tensors
+  return [ dataset.index.decode_batch(t[col][i, :t[lencol][i]]).tolist() for i in range(len(dataset)) ]
+
+if __name__ == '__main__':
+  args = parseSystemArgs()
+  spacy_set, spacy_time = load(args, 'spacy')
+  regex_set, regex_time = load(args, 'regex')
+
+  spacy_seqs, regex_seqs = sequences(spacy_set), sequences(regex_set)
+  exact = sum(a == b for a, b in zip(spacy_seqs, regex_seqs))
+  common = sum(sum((collections.Counter(a) & collections.Counter(b)).values()) for a, b in zip(spacy_seqs, regex_seqs))
+  nspacy, nregex = sum(map(len, spacy_seqs)), sum(map(len, regex_seqs))
+  precision, recall = common / nregex, common / nspacy
+  entities = sum(a == b for c in [ 'e1', 'e2' ] for a, b in zip(sequences(spacy_set, 'seq_' + c, 'seqlen_' + c), sequences(regex_set, 'seq_' + c, 'seqlen_' + c)))
+
+  print(f'samples:                   {len(spacy_set):d}')
+  print(f'time spacy / regex:        {spacy_time:.2f}s / {regex_time:.2f}s ({spacy_time / regex_time:.1f}x)')
+  print(f'vocabulary spacy / regex:  {len(spacy_set.index):d} / {len(regex_set.index):d}')
+  print(f'identical sequences:       {exact / len(spacy_set):.4f}')
+  print(f'token P / R / F (vs spacy): {precision:.4f} / {recall:.4f} / {2 * precision * recall / (precision + recall):.4f}')
+  print(f'identical entities:        {entities / (2 * len(spacy_set)):.4f}')
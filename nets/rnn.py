@@ -37,6 +37,7 @@ class ReClass(torch.nn.Module):
     super(ReClass, self).__init__()
     
     self.window_size = window_size
+    self.convwindow = convwindow
     self.fs = window_size * (emsizeword + 2 * emsizeposi) # size of the feature vector for words
     
     # layers
@@ -49,7 +50,7 @@ class ReClass(torch.nn.Module):
       raise ValueError( '''Invalid option `%s` for 'conv-activation'.''' % conv_activation)
     self.convact = getattr(torch.nn, conv_activation)()
     self.d2 = torch.nn.Dropout(dropout)
-    self.maxpool = torch.nn.MaxPool2d(((maxseqlength-window_size//2-1) - (convwindow-1),1))
+    # max pooling is done over the valid positions of each sequence, so batches do not need to be padded to `maxseqlength`
     self.linear_sentence = torch.nn.Linear(numconvfilters, nhid)
     self.linear_classify = torch.nn.Linear((maxentlength * emsizeword * 2) + nhid, nclasses)
     self.d3 = torch.nn.Dropout(dropout)
@@ -76,7 +77,7 @@ class ReClass(torch.nn.Module):
     self.class_embeddings.weight.data.uniform_(-initrange, initrange)
 
   def forward(self, seq, seqlen, e1, e1len, e2, e2len, offs_e1, offs_e2, seqp_e1, seqp_e2):
-    # seq = batch_size x max_seq_length (padded) : sentence
+    # seq = batch_size x max_seq_length (padded, to the global or to the batch maximum) : sentence
     # seqlen = batch_size x seq_length
     # e1 & e2 = batch_size x 2 : offsets as begin e[0] and end e[1]
     # seqpX = batch_size x max_seqlength (padded) : sentence as relative position indices to e1 and e2
@@ -95,8 +96,7 @@ class ReClass(torch.nn.Module):
     c = self.conv(w)
     c = self.convact(c) # because it's a good policy
     c = self.d2(c) # yet another good policy, although debatable if it should come here
-    z = self.maxpool(c)
-    z = z.squeeze() # remove trailing singular dimensions (f: batch_size x numfilters x 1 x 1 => batch_size x numfilters)
+    z = self.maxpool(c, seqlen)
     # linear layer to squash into fixed number of features
     g = self.linear_sentence(z)
     ## END: sentence level features
@@ -119,6 +119,19 @@ class ReClass(torch.nn.Module):
     
     return o, 0
   
+  def maxpool(self, c, seqlen):
+    '''
+    in:  c = batch_size x numfilters x conv_length x 1, seqlen = batch_size
+    out:     batch_size x numfilters
+    
+    max over the convolution outputs whose window lies completely inside the sequence, outputs
+    which cover padding are masked, at least the first output is always used
+    '''
+    nvalid = (seqlen - self.window_size - self.convwindow + 2).clamp(min=1)
+    mask = torch.arange(c.size(2), device=c.device)[None, :] >= nvalid[:, None]
+    c = c.squeeze(3).masked_fill(mask.unsqueeze(1), float('-inf'))
+    return c.max(dim=2)[0]
+
   @staticmethod
   def window_cat(seq, n):
     '''
@@ -343,17 +356,41 @@ class RNN_CLASSIFY_simple(torch.nn.Module):
     self.fc = torch.nn.Linear(nhid, nclasses)
   
   def forward(self, x):
+    # x = batch_size x seq_length x ntoken (one-hot) or batch_size x seq_length (token ids)
     # Set initial hidden and cell states 
-    h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(self.device()) 
-    c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(self.device())
+    h0 = torch.zeros(self.nlayers, x.size(0), self.nhid, device=x.device) 
+    c0 = torch.zeros(self.nlayers, x.size(0), self.nhid, device=x.device)
     
     # Forward propagate LSTM
-    out, _ = self.lstm(x, (h0, c0))  # out: tensor of shape (batch_size, seq_length, hidden_size)
+    if x.dtype == torch.long:
+      out = self.lstm_ids(x, h0, c0)
+    else:
+      out, _ = self.lstm(x, (h0, c0))  # out: tensor of shape (batch_size, seq_length, hidden_size)
     
     # Decode the hidden state of the last time step
     out = self.fc(out[:, -1, :])
     return out
 
+  def lstm_ids(self, x, h0, c0):
+    # `self.lstm` over token ids, the input projection of one-hot vectors is a lookup of the
+    # columns of the input weights, the gates are computed directly from it
+    out = None
+    for layer in range(self.nlayers):
+      w_ih, w_hh, b_ih, b_hh = (getattr(self.lstm, f'{name}_l{layer:d}') for name in [ 'weight_ih', 'weight_hh', 'bias_ih', 'bias_hh' ])
+      if layer == 0:
+        gates_x = torch.nn.functional.embedding(x, w_ih.t()) + b_ih
+      else:
+        gates_x = torch.nn.functional.linear(out, w_ih, b_ih)
+      h, c = h0[layer], c0[layer]
+      outputs = []
+      for t in range(x.size(1)):
+        i, f, g, o = (gates_x[:, t] + torch.nn.functional.linear(h, w_hh, b_hh)).chunk(4, dim=1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        outputs.append(h)
+      out = torch.stack(outputs, dim=1)
+    return out
+
   
 class RNN_CLASSIFY_linear(torch.nn.Module):
   '''
@@ -369,13 +406,29 @@ class RNN_CLASSIFY_linear(torch.nn.Module):
     self.softmax = torch.nn.LogSoftmax(dim=1)
 
   def forward(self, inputs, hidden):
-    # inputs = batch_size x ntoken
-    i_h = torch.cat((inputs, hidden), dim=1)
-    h = self.i2h(i_h)
-    o = self.i2o(i_h)
+    # inputs = batch_size x ntoken (dense or sparse, e.g. from `utils.makeSparseBow`),
+    #          batch_size (token ids, same as one-hot) or batch_size x n (bags of token ids, same as bag-of-words)
+    if inputs.dtype != torch.long and not inputs.is_sparse:
+      i_h = torch.cat((inputs, hidden), dim=1)
+      h = self.i2h(i_h)
+      o = self.i2o(i_h)
+    else:
+      h = self.project(self.i2h, inputs, hidden)
+      o = self.project(self.i2o, inputs, hidden)
     o = self.softmax(o)
     return o, h
 
+  def project(self, linear, inputs, hidden):
+    # `linear(torch.cat((inputs, hidden), dim=1))` without dense inputs
+    w_in = linear.weight[:, :self.ntoken].t()
+    if inputs.is_sparse:
+      x = torch.sparse.mm(inputs, w_in)
+    elif inputs.dim() == 1:
+      x = torch.nn.functional.embedding(inputs, w_in)
+    else:
+      x = torch.nn.functional.embedding_bag(inputs, w_in, mode='sum')
+    return x + torch.nn.functional.linear(hidden, linear.weight[:, self.ntoken:], linear.bias)
+
   def init_hidden(self, batch_size):
     w = next(self.parameters())
     return w.new_zeros(batch_size, self.nhid).uniform_(-.1, .1)
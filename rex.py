@@ -4,6 +4,7 @@ import sys
 if not '..' in sys.path: sys.path.append('..')
 
 import argparse
+import functools
 import time
 import os
 from tqdm import tqdm
@@ -54,6 +55,13 @@ def parseSystemArgs():
   parser.add_argument('--shuffle-samples', action='store_true', help='shuffle samples')
   parser.add_argument('--cuda', action='store_true', help='use CUDA')
   parser.add_argument('--engine', action='store_true', help='use torchnet engine for training and testing.')
+  parser.add_argument('--bucketing', action='store_true', help='batch sentences of similar length and pad each batch only to its longest sentence')
+  parser.add_argument('--max-tokens', default=0, type=int, help='pack batches up to this many (padded) tokens instead of using a fixed batch size (0 = use --batch-size)')
+  parser.add_argument('--megabatch-size', default=0, type=int, help='with --max-tokens, sort sentences by length within shuffled groups of this many sentences (0 = sort all)')
+  parser.add_argument('--batched', action='store_true', help='gather whole batches from the dataset at once instead of collating single samples')
+  parser.add_argument('--tokenizer', default='spacy', type=str, help='tokenizer for preprocessing the corpus (spacy, regex)')
+  parser.add_argument('--nlp-processes', default=1, type=int, help='number of processes for annotating the corpus with spacy (only used when preprocessing)')
+  parser.add_argument('--prefetch', default=0, type=int, help='number of batches to prepare in a background thread (0 = no prefetching)')
   args = parser.parse_args()
     
   # Set the random seed manually for reproducibility.
@@ -68,7 +76,7 @@ def parseSystemArgs():
 def loadData(args):
   index = utils.Index(initwords = ['<unk>'], unkindex = 0)
   
-  trainset = data.SemEval2010('data/semeval2010/', subset='train.txt', nlines = None, index = index, maxdist = args.maxdist, nbos = args.windowsize // 2, neos = args.windowsize // 2).to(args.device)
+  trainset = data.SemEval2010('data/semeval2010/', subset='train.txt', nlines = None, tokenizer = args.tokenizer, nlp_processes = args.nlp_processes, index = index, maxdist = args.maxdist, nbos = args.windowsize // 2, neos = args.windowsize // 2).to(args.device)
   
   trainset.index.freeze(silent = True).tofile(os.path.join('data/semeval2010/', 'vocab.txt'))
   trainset.posiindex.freeze(silent = True).tofile(os.path.join('data/semeval2010/', 'position-index.txt'))
@@ -77,7 +85,7 @@ def loadData(args):
   trainset.dclassindex.freeze(silent = False).tofile(os.path.join('data/semeval2010/', 'classes-direction.txt'))
   trainset.eclassindex.freeze(silent = False).tofile(os.path.join('data/semeval2010/', 'classes-entity.txt'))
   
-  testset = data.SemEval2010('data/semeval2010/', subset='test.txt', nlines = None, maxseqlen = trainset.maxseqlen, maxentlen = trainset.maxentlen, index = index, nbos = args.windowsize // 2, neos = args.windowsize // 2, maxdist=args.maxdist, posiindex = trainset.posiindex, classindex = trainset.classindex, rclassindex = trainset.rclassindex, dclassindex = trainset.dclassindex, eclassindex = trainset.eclassindex).to(args.device)
+  testset = data.SemEval2010('data/semeval2010/', subset='test.txt', nlines = None, tokenizer = args.tokenizer, nlp_processes = args.nlp_processes, maxseqlen = trainset.maxseqlen, maxentlen = trainset.maxentlen, index = index, nbos = args.windowsize // 2, neos = args.windowsize // 2, maxdist=args.maxdist, posiindex = trainset.posiindex, classindex = trainset.classindex, rclassindex = trainset.rclassindex, dclassindex = trainset.dclassindex, eclassindex = trainset.eclassindex).to(args.device)
   
   print('train: ' + str(trainset))
   print('test: ' + str(testset))
@@ -101,11 +109,30 @@ def loadData(args):
     preemb_weights = None
   
   __ItemSampler = RandomSampler if args.shuffle_samples else SequentialSampler
-  train_loader = torch.utils.data.DataLoader(trainset, batch_sampler = utils.ShufflingBatchSampler(BatchSampler(__ItemSampler(trainset), batch_size=args.batch_size, drop_last = False), shuffle = args.shuffle_batches, seed = args.seed), num_workers = 0)
-  test_loader = torch.utils.data.DataLoader(testset, batch_sampler = BatchSampler(__ItemSampler(testset), batch_size=args.batch_size, drop_last = False), num_workers = 0)
+  collate_fn = data.SemEval2010.collate_batch if args.batched else None
+  if args.max_tokens > 0:
+    collate_fn = functools.partial(data.SemEval2010.collate_trimmed, collate_fn = collate_fn or torch.utils.data.dataloader.default_collate)
+    train_sampler = utils.TokenBudgetBatchSampler(trainset.samples.seqlen.values, max_tokens = args.max_tokens, megabatch_size = args.megabatch_size, shuffle = True, seed = args.seed)
+    test_sampler = utils.TokenBudgetBatchSampler(testset.samples.seqlen.values, max_tokens = args.max_tokens, shuffle = False)
+  elif args.bucketing:
+    collate_fn = functools.partial(data.SemEval2010.collate_trimmed, collate_fn = collate_fn or torch.utils.data.dataloader.default_collate)
+    train_sampler = utils.BucketingBatchSampler(trainset.samples.seqlen.values, batch_size = args.batch_size, drop_last = False, shuffle = True, seed = args.seed)
+    test_sampler = utils.BucketingBatchSampler(testset.samples.seqlen.values, batch_size = args.batch_size, drop_last = False, shuffle = False)
+  else:
+    train_sampler = utils.ShufflingBatchSampler(BatchSampler(__ItemSampler(trainset), batch_size=args.batch_size, drop_last = False), shuffle = args.shuffle_batches, seed = args.seed)
+    test_sampler = BatchSampler(__ItemSampler(testset), batch_size=args.batch_size, drop_last = False)
+  train_loader = torch.utils.data.DataLoader(trainset.batched(args.batched), batch_sampler = train_sampler, num_workers = 0, collate_fn = collate_fn)
+  test_loader = torch.utils.data.DataLoader(testset.batched(args.batched), batch_sampler = test_sampler, num_workers = 0, collate_fn = collate_fn)
+
+  if args.prefetch > 0:
+    train_loader = utils.PrefetchingLoader(train_loader, nprefetch = args.prefetch, pin_memory = args.cuda)
+    test_loader = utils.PrefetchingLoader(test_loader, nprefetch = args.prefetch, pin_memory = args.cuda)
 
   print(__ItemSampler.__name__)
   print('Shuffle training batches: ', args.shuffle_batches)
+  print('Batched access: ', args.batched)
+  print('Length bucketing: ', args.bucketing)
+  print('Token budget: ', args.max_tokens)
 
   args.maxseqlen = trainset.maxseqlen
   args.maxentlen = trainset.maxentlen
@@ -311,14 +338,14 @@ def pipeline(args):
         batch_data.append(False)
         loss, (sampleids, outputs, predictions_, targets_) = process(batch_data)
         # keep track of some scores
-        total_loss += args.batch_size * loss.item()
+        total_loss += targets_.size(0) * loss.item()
         args.confusion_meter.add(outputs.data, targets_)
         ids.extend(sampleids.tolist())
         logprobs.extend(outputs.data.tolist())
         predictions.extend(predictions_.tolist())
         targets.extend(targets_.tolist())
         
-    test_loss = total_loss / (len(dloader) * args.batch_size )
+    test_loss = total_loss / max(len(ids), 1)
     return test_loss, ids, logprobs, predictions, targets
   
   
@@ -330,15 +357,22 @@ def pipeline(args):
     interval_loss = 0.
     predictions = []
     targets = []
+    nsamples = 0
+    ntokens = 0
+    npadded = 0
+    start_time = time.time()
     
     for batch, batch_data in enumerate(tqdm(args.trainloader, ncols=89, desc='Train')):
       batch_start_time = time.time()
+      ntokens += batch_data[3].sum().item()
+      npadded += batch_data[2].numel()
       model.zero_grad()
       loss, (_, outputs, predictions_, targets_) = process(batch_data + [ True ])
       loss.backward()
       args.optimizer.step()
-      # track some scores
-      train_loss += loss.item()
+      # track some scores, batches differ in size (e.g. with --max-tokens), so weight by the number of samples
+      nsamples += targets_.size(0)
+      train_loss += targets_.size(0) * loss.item()
       interval_loss += loss.item()
       
       args.confusion_meter.add(outputs.data, targets_)
@@ -346,11 +380,13 @@ def pipeline(args):
       targets.extend(targets_.tolist())
   
       if batch % args.log_interval == 0 and batch > 0:
-        cur_loss = train_loss / args.log_interval
+        cur_loss = interval_loss / args.log_interval
         scores = getscores(targets, predictions)
         tqdm.write(message_status_interval('Current Status:', epoch+1, args.epochs, batch, len(args.trainloader), batch_start_time, args.log_interval, cur_loss, scores))
         interval_loss = 0.
-      train_loss = train_loss / (len(args.trainloader) * args.batch_size)
+    train_loss = train_loss / max(nsamples, 1)
+    args.tokenspersec = ntokens / (time.time() - start_time)
+    args.paddingratio = 1. - ntokens / max(npadded, 1)
     return train_loss, predictions, targets
 
   ###
@@ -364,6 +400,9 @@ def pipeline(args):
     test_loss, sampleids, logprobs, predictions, targets = evaluate(args, args.testloader)
     scores = getscores(targets, predictions)
     tqdm.write(message_status_endepoch('', epoch+1, epoch_start_time, args.optimizer.getLearningRate(), train_loss, test_loss, scores))
+    tqdm.write(f'|   +-- Tokens/s (train) {args.tokenspersec:.0f} ({100 * args.paddingratio:.1f}% padding)\n|')
+    if args.prefetch > 0:
+      tqdm.write(f'|   +-- Waited for data {args.trainloader.waittime:.2f}s (train) {args.testloader.waittime:.2f}s (test)\n|')
     if best_test_val < scores['F']:
       tqdm.write('> Saving model and prediction results...')
       savemodel(args)
@@ -6,7 +6,16 @@ Created on Fri Jul 27 20:15:22 2018
 @author: rem
 """
 
-import random
+import time
+import queue
+import threading
+import itertools
+import hashlib
+import collections
+import mmap
+import struct
+import zlib
+import numpy as np
 import torch.utils.data
 
 requiredParam = object()
@@ -26,6 +35,7 @@ class Index(object):
   def __init__(self, initwords = [], unkindex = None):
     self.id2w = []
     self.w2id = {}
+    self.counts = collections.Counter() # id -> frequency, only updated while the index is not frozen
     self.frozen = False
     self.unkindex = unkindex
     if initwords is not None:
@@ -34,7 +44,10 @@ class Index(object):
 
   def add(self, word):
     if word in self.w2id:
-      return self.w2id[word]
+      idx = self.w2id[word]
+      if not self.frozen:
+        self.counts[idx] += 1
+      return idx
     if self.frozen:
       if not self.silentlyfrozen:
         raise ValueError('Index can not be altered anymore. It is already frozen.')
@@ -43,7 +56,11 @@ class Index(object):
     idx = len(self.id2w)
     self.w2id[word] = idx
     self.id2w.append(word)
+    self.counts[idx] += 1
     return idx
+
+  def getCount(self, idx):
+    return int(self.counts[idx])
   
   def size(self):
     return len(self.w2id)
@@ -63,10 +80,156 @@ class Index(object):
     except KeyError:
       return self.unkindex
   
-  def tofile(self, fname):
+  def encode_batch(self, sequences, dtype = np.int64, grow = True):
+    '''
+    Encode a list of token lists at once, returns `(ids, offsets)` where `ids` is
+    a flat array of all token ids and `sequence[i]` is `ids[offsets[i]:offsets[i+1]]`.
+    Known tokens are resolved in a single pass, only unknown tokens go through `add`
+    (in order of appearance, so ids are the same as calling `add` on every token).
+    If `grow` is False or the index is frozen, unknown tokens are mapped to `unkindex`.
+    '''
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = list(itertools.chain.from_iterable(sequences))
+    ids = np.fromiter(map(self.w2id.get, tokens, itertools.repeat(-1)), dtype=np.int64, count=len(tokens))
+    misses = np.flatnonzero(ids < 0)
+    if grow and not self.frozen:
+      self.counts.update(ids[ids >= 0].tolist()) # misses are counted by `add`
+    if len(misses) > 0:
+      if grow and (not self.frozen or not self.silentlyfrozen):
+        ids[misses] = [ self.add(tokens[i]) for i in misses.tolist() ]
+      elif self.unkindex is None:
+        raise ValueError('Index has no `unkindex` for unknown tokens.')
+      else:
+        ids[misses] = self.unkindex
+    return ids.astype(dtype, copy=False), offsets
+
+  def merge(self, words, counts):
+    '''
+    Add `words` which occurred `counts` times each (e.g. the vocabulary of another index),
+    returns the ids of the words in this index.
+    '''
+    ids, _ = self.encode_batch([ words ])
+    if not self.frozen:
+      for idx, c in zip(ids.tolist(), counts):
+        self.counts[idx] += c - 1
+    return ids
+
+  def prune(self, min_count = 1, max_size = None, keep = ()):
+    '''
+    Remove words which occurred less than `min_count` times, keep at most `max_size` words
+    and re-assign the ids in descending order of frequency (ties keep their first-seen order).
+    The unknown word and the words in `keep` are never removed and get the lowest ids.
+    Returns `mapping` with `mapping[oldid] = newid`, removed words are mapped to `unkindex`,
+    use it to remap data which was encoded with this index before.
+    '''
+    n = len(self.id2w)
+    protected = set(self.w2id[w] for w in keep if w in self.w2id)
+    if self.unkindex is not None:
+      protected.add(self.unkindex)
+    protected = np.array(sorted(protected), dtype=np.int64)
+    counts = np.zeros(n, dtype=np.int64)
+    if self.counts:
+      ids = np.fromiter(self.counts.keys(), dtype=np.int64, count=len(self.counts))
+      counts[ids] = np.fromiter(self.counts.values(), dtype=np.int64, count=len(self.counts))
+    isprotected = np.zeros(n, dtype=bool)
+    isprotected[protected] = True
+    others = np.flatnonzero(~isprotected & (counts >= min_count))
+    others = others[np.argsort(-counts[others], kind='stable')]
+    if max_size is not None:
+      others = others[:max(0, max_size - len(protected))]
+    order = np.concatenate((protected, others))
+    if len(order) < n and self.unkindex is None:
+      raise ValueError('Index has no `unkindex` for pruned words.')
+    mapping = np.full(n, -1, dtype=np.int64)
+    mapping[order] = np.arange(len(order))
+    unkindex = None if self.unkindex is None else int(mapping[self.unkindex])
+    mapping[mapping < 0] = -1 if unkindex is None else unkindex
+    newcounts = np.zeros(len(order), dtype=np.int64)
+    np.add.at(newcounts, mapping, counts) # counts of removed words go to the unknown word
+    counts = collections.Counter(dict(enumerate(newcounts.tolist())))
+    self.id2w = [ self.id2w[i] for i in order.tolist() ]
+    self.w2id = { w: i for i, w in enumerate(self.id2w) }
+    self.counts = counts
+    self.unkindex = unkindex
+    self._wordarray_cache = None
+    return mapping
+
+  def decode_batch(self, ids, offsets = None):
+    '''
+    Inverse of `encode_batch`, `ids` may be a numpy array or a tensor of any shape.
+    Returns an array of words with the same shape as `ids`, or a list of word lists
+    if `offsets` are given.
+    '''
+    ids = np.asarray(ids)
+    words = self._wordarray()[ids]
+    if offsets is None:
+      return words
+    offsets = np.asarray(offsets)
+    return [ words[offsets[i]:offsets[i+1]].tolist() for i in range(len(offsets) - 1) ]
+
+  def _wordarray(self):
+    # cached object array of all words, ids are only ever appended, so the size tells if it is still valid
+    cache = getattr(self, '_wordarray_cache', None)
+    if cache is None or len(cache) != len(self.id2w):
+      cache = np.empty(len(self.id2w), dtype=object)
+      cache[:] = list(self.id2w)
+      self._wordarray_cache = cache
+    return cache
+
+  def fingerprint(self):
+    '''
+    Hash over the words, their order, their counts and the freezing state, i.e. everything
+    that determines the state of the index after `add` or `encode_batch`.
+    '''
+    h = hashlib.sha1()
+    for w in self.id2w:
+      h.update(str(w).encode('utf8'))
+      h.update(b'\x00')
+    h.update(np.array([ self.getCount(i) for i in range(len(self.id2w)) ], dtype=np.int64).tobytes())
+    h.update(repr((self.frozen, getattr(self, 'silentlyfrozen', False), self.unkindex)).encode('utf8'))
+    return h.hexdigest()
+
+  def tofile(self, fname, binary = False, counts = False):
+    if binary:
+      return self.tobinfile(fname)
     with open(fname, 'w') as f:
-      lines = map(lambda w: str(w) + '\n', self.id2w)
+      if counts:
+        lines = map(lambda tup: f'{tup[1]}\t{self.getCount(tup[0]):d}\n', enumerate(self.id2w))
+      else:
+        lines = map(lambda w: str(w) + '\n', self.id2w)
       f.writelines(lines)
+
+  def tobinfile(self, fname):
+    '''
+    Write the index in the binary format which can be opened with `MappedIndex`:
+      header | offsets (int64, n+1) | hash table (int64, nslots) | counts (int64, n) | utf-8 blob
+    Words are stored as `str(w)`, they may contain any character including newlines.
+    '''
+    words = [ str(w).encode('utf8') for w in self.id2w ]
+    n = len(words)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([ len(b) for b in words ], out=offsets[1:])
+    # open addressing with linear probing, at most half of the slots are used
+    nslots = 8
+    while nslots < 2 * n:
+      nslots <<= 1
+    mask = nslots - 1
+    table = np.full(nslots, -1, dtype=np.int64)
+    for i, b in enumerate(words):
+      h = zlib.crc32(b) & mask
+      while table[h] >= 0:
+        h = (h + 1) & mask
+      table[h] = i
+    counts = np.array([ self.getCount(i) for i in range(n) ], dtype=np.int64)
+    unkindex = -1 if self.unkindex is None else self.unkindex
+    with open(fname, 'wb') as f:
+      f.write(struct.pack(MappedIndex.HEADER, MappedIndex.MAGIC, MappedIndex.VERSION, n, nslots, unkindex))
+      f.write(offsets.tobytes())
+      f.write(table.tobytes())
+      f.write(counts.tobytes())
+      f.write(b''.join(words))
       
   def freeze(self, silent = False):
     self.frozen = True
@@ -104,14 +267,116 @@ class Index(object):
         '     ...\n' if len(self.id2w) > len(subseq) else '')
   
   @staticmethod
-  def fromfile(fname):
+  def fromfile(fname, counts = False):
+    with open(fname, 'rb') as f:
+      if f.read(len(MappedIndex.MAGIC)) == MappedIndex.MAGIC:
+        return MappedIndex(fname)
     index = Index()
     with open(fname, 'r', encoding='utf8') as f:
       for i, line in enumerate(f):
         w = line.rstrip()
+        if counts:
+          w, c = w.rsplit('\t', 1)
+          index.counts[i] = int(c)
         index.id2w.append(w)
         index.w2id[w] = i
     return index
+
+
+class MappedIndex(Index):
+  '''
+  Read-only Index backed by a memory mapped file written with `Index.tobinfile`.
+  Opening is O(1), lookups work directly on the mapped arrays and the pages
+  are shared among all processes on the same host which open the same file.
+
+    index.tofile('vocab.bin', binary = True)
+    index = Index.fromfile('vocab.bin') # == MappedIndex('vocab.bin')
+  '''
+  MAGIC = b'\x00IDX'
+  VERSION = 2
+  HEADER = '<4sIQQq' # magic, version, nwords, nslots, unkindex (-1 = None)
+
+  def __init__(self, fname):
+    self.fname = fname
+    with open(fname, 'rb') as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, n, nslots, unkindex = struct.unpack_from(self.HEADER, self._mm, 0)
+    if magic != self.MAGIC or version != self.VERSION:
+      raise ValueError(f'{fname:s} is not a binary index file of version {self.VERSION:d}.')
+    offs = struct.calcsize(self.HEADER)
+    self._offsets = np.frombuffer(self._mm, dtype=np.int64, count=n+1, offset=offs)
+    offs += self._offsets.nbytes
+    self._table = np.frombuffer(self._mm, dtype=np.int64, count=nslots, offset=offs)
+    offs += self._table.nbytes
+    self.counts = np.frombuffer(self._mm, dtype=np.int64, count=n, offset=offs)
+    offs += self.counts.nbytes
+    self._blob = np.frombuffer(self._mm, dtype=np.uint8, count=int(self._offsets[-1]), offset=offs)
+    self._mask = nslots - 1
+    self.id2w = MappedIndex._Words(self)
+    self.w2id = MappedIndex._Ids(self)
+    self.unkindex = None if unkindex < 0 else unkindex
+    self.frozen = True
+    self.silentlyfrozen = False
+
+  def _word(self, idx):
+    return self._blob[self._offsets[idx]:self._offsets[idx+1]].tobytes().decode('utf8')
+
+  def _find(self, word):
+    b = str(word).encode('utf8')
+    h = zlib.crc32(b) & self._mask
+    while True:
+      idx = int(self._table[h])
+      if idx < 0:
+        return None
+      if self._blob[self._offsets[idx]:self._offsets[idx+1]].tobytes() == b:
+        return idx
+      h = (h + 1) & self._mask
+
+  def freeze(self, silent = False):
+    self.silentlyfrozen = silent
+    return self
+
+  def __getstate__(self):
+    return dict(fname=self.fname, silentlyfrozen=self.silentlyfrozen)
+
+  def __setstate__(self, state):
+    self.__init__(state['fname'])
+    self.silentlyfrozen = state['silentlyfrozen']
+
+  class _Words(object):
+    # list-like view on the mapped words, used as `id2w`
+    def __init__(self, index):
+      self.index = index
+    def __len__(self):
+      return len(self.index._offsets) - 1
+    def __getitem__(self, idx):
+      if isinstance(idx, slice):
+        return [ self.index._word(i) for i in range(*idx.indices(len(self))) ]
+      if idx < 0:
+        idx += len(self)
+      if idx < 0 or idx >= len(self):
+        raise IndexError('index out of range')
+      return self.index._word(idx)
+    def __iter__(self):
+      return (self.index._word(i) for i in range(len(self)))
+
+  class _Ids(object):
+    # dict-like view on the mapped hash table, used as `w2id`
+    def __init__(self, index):
+      self.index = index
+    def __len__(self):
+      return len(self.index._offsets) - 1
+    def __contains__(self, word):
+      return self.index._find(word) is not None
+    def __getitem__(self, word):
+      idx = self.index._find(word)
+      if idx is None:
+        raise KeyError(word)
+      return idx
+    def get(self, word, default = None):
+      idx = self.index._find(word)
+      return default if idx is None else idx
+
   
 class Attention(torch.nn.Module):
   '''
@@ -140,52 +405,237 @@ class Attention(torch.nn.Module):
       torch.nn.init.xavier_normal(out)
       return out
 
-class RandomBatchSampler(torch.utils.data.sampler.BatchSampler):
-  
-  def __init__(self, *args, **kwargs):
-    super(RandomBatchSampler, self).__init__(*args, **kwargs)
-    
-  def __iter__(self):
-    batches = list(super().__iter__())
-    random.shuffle(batches)
-    for batch in batches:
-      yield batch
-      
+def batchResolver(batchsampler):
+  '''
+  Return `(nbatches, batch)` for one epoch of `batchsampler`, where `batch(i)` returns the i-th
+  batch as a list of indices. Samplers which can compute their batches (`resolver()`, a
+  `BatchSampler` over a `SequentialSampler`) are not iterated, all others are iterated once
+  into a flat index array and batch offsets.
+  '''
+  if hasattr(batchsampler, 'resolver'):
+    return batchsampler.resolver()
+  if type(batchsampler) is torch.utils.data.sampler.BatchSampler:
+    sampler, bs, nbatch = batchsampler.sampler, batchsampler.batch_size, len(batchsampler)
+    n = len(sampler)
+    if isinstance(sampler, torch.utils.data.sampler.SequentialSampler):
+      return nbatch, lambda i: list(range(i * bs, min(n, (i + 1) * bs)))
+    indices = np.fromiter(iter(sampler), dtype=np.int64, count=n)
+    return nbatch, lambda i: indices[i * bs:(i + 1) * bs].tolist()
+  lengths = []
+  def flatten():
+    for batch in batchsampler:
+      lengths.append(len(batch))
+      yield from batch
+  indices = np.fromiter(flatten(), dtype=np.int64)
+  offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+  return len(lengths), lambda i: indices[offsets[i]:offsets[i + 1]].tolist()
+
 class ShufflingBatchSampler(torch.utils.data.sampler.BatchSampler):
-  
+  '''
+  Return the batches of `batchsampler` in a different order in every epoch. Only a permutation
+  of the batch ids is shuffled (with a private generator seeded by `seed + epoch`), the batches
+  are resolved when they are returned, see `batchResolver`. `state_dict()` holds the epoch and
+  the number of batches returned in it, after `load_state_dict()` the next iteration continues
+  at exactly that batch.
+
+    ShufflingBatchSampler(BatchSampler(SequentialSampler(trainset), batch_size = 50, drop_last = False), seed = 10101)
+  '''
   def __init__(self, batchsampler, shuffle = True, seed = 10101):
     self.batchsampler = batchsampler
-    self.shuffle = True
+    self.shuffle = shuffle
     self.seed = seed
-    self.numitercalls = -1
+    self.epoch = 0
+    self.nextbatch = 0
+    self.resume = False
+
+  def order(self, epoch, nbatch):
+    if not self.shuffle:
+      return np.arange(nbatch, dtype=np.int64)
+    return np.random.default_rng(self.seed + epoch).permutation(nbatch).astype(np.int32 if nbatch < 1 << 31 else np.int64)
+
+  def __iter__(self):
+    if not self.resume and self.nextbatch > 0: # previous iteration was abandoned
+      self.epoch, self.nextbatch = self.epoch + 1, 0
+    self.resume = False
+    epoch = self.epoch
+    nbatch, batch = batchResolver(self.batchsampler)
+    order = self.order(epoch, nbatch)
+    for i in range(self.nextbatch, nbatch):
+      self.nextbatch = i + 1
+      yield batch(int(order[i]))
+    if self.epoch == epoch:
+      self.epoch, self.nextbatch = epoch + 1, 0
+      
+  def __len__(self):
+    return len(self.batchsampler)
+
+  def state_dict(self):
+    return { 'epoch': self.epoch, 'batch': self.nextbatch, 'seed': self.seed, 'shuffle': self.shuffle }
+
+  def load_state_dict(self, state):
+    self.epoch, self.nextbatch = state['epoch'], state['batch']
+    self.seed, self.shuffle = state.get('seed', self.seed), state.get('shuffle', self.shuffle)
+    self.resume = True
+    return self
+
+class RandomBatchSampler(ShufflingBatchSampler):
+  '''
+  `BatchSampler` which returns its batches in random order, see `ShufflingBatchSampler`.
+  Without a `seed` a random one is drawn, it is part of the `state_dict()`.
+  '''
+  def __init__(self, sampler, batch_size, drop_last, seed = None):
+    if seed is None:
+      seed = int(np.random.SeedSequence().entropy % (1 << 63))
+    super(RandomBatchSampler, self).__init__(torch.utils.data.sampler.BatchSampler(sampler, batch_size, drop_last), shuffle = True, seed = seed)
+    self.sampler = sampler
+    self.batch_size = batch_size
+    self.drop_last = drop_last
     
+class BucketingBatchSampler(torch.utils.data.sampler.Sampler):
+  '''
+  Group samples of similar length into batches, so that each batch only needs to be padded to
+  its own maximum length. Samples are sorted by length (ties in random order), cut into
+  batches and the order of the batches is shuffled in every epoch.
+
+    BucketingBatchSampler(trainset.samples.seqlen.values, batch_size = 50)
+  '''
+  def __init__(self, lengths, batch_size, drop_last = False, shuffle = True, seed = 10101):
+    self.lengths = np.asarray(lengths)
+    self.batch_size = batch_size
+    self.drop_last = drop_last
+    self.shuffle = shuffle
+    self.seed = seed
+    self.numitercalls = -1
+
   def __iter__(self):
     self.numitercalls += 1
-    batches = self.batchsampler.__iter__()
+    rng = np.random.RandomState(self.seed + self.numitercalls)
+    order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+    order = order[np.argsort(self.lengths[order], kind='stable')]
+    batches = [ order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size) ]
+    if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+      batches.pop()
     if self.shuffle:
-      batches = list(batches)
-      random.seed(self.seed+self.numitercalls)
-      random.shuffle(batches)
+      batches = [ batches[i] for i in rng.permutation(len(batches)) ]
     for batch in batches:
-      yield batch
-      
+      yield batch.tolist()
+
   def __len__(self):
-    return len(self.batchsampler)
-      
-    
+    if self.drop_last:
+      return len(self.lengths) // self.batch_size
+    return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+class TokenBudgetBatchSampler(torch.utils.data.sampler.Sampler):
+  '''
+  Pack samples into batches of varying size, such that each batch padded to its longest sample
+  holds at most `max_tokens` tokens (`len(batch) * max(lengths[batch]) <= max_tokens`), a sample
+  longer than the budget forms a batch on its own. In every epoch the samples are shuffled and
+  cut into mega-batches of `megabatch_size` samples (None = all samples), with `sort` the samples
+  of a mega-batch are sorted by length before packing, and the order of the batches is shuffled.
+  `max_batch_size` additionally limits the number of samples per batch.
+
+    TokenBudgetBatchSampler(trainset.samples.seqlen.values, max_tokens = 2000, megabatch_size = 2000)
+    TokenBudgetBatchSampler(spamset.seqlen, max_tokens = 4000)
+  '''
+  def __init__(self, lengths, max_tokens, megabatch_size = None, sort = True, shuffle = True, max_batch_size = None, seed = 10101):
+    self.lengths = np.maximum(np.asarray(lengths, dtype=np.int64), 1)
+    self.max_tokens = max_tokens
+    self.megabatch_size = megabatch_size or max(len(self.lengths), 1)
+    self.sort = sort
+    self.shuffle = shuffle
+    self.max_batch_size = max_batch_size or len(self.lengths)
+    self.seed = seed
+    self.numitercalls = -1
+    self.epochbatches = (None, None)
+    self.current = None
+
+  def pack(self, order):
+    batches = []
+    start, maxlen = 0, 0
+    for i, l in enumerate(self.lengths[order].tolist()):
+      maxlen = max(maxlen, l)
+      if i > start and ((i - start + 1) * maxlen > self.max_tokens or i - start >= self.max_batch_size):
+        batches.append(order[start:i])
+        start, maxlen = i, l
+    if start < len(order):
+      batches.append(order[start:])
+    return batches
+
+  def batches(self, epoch):
+    if self.epochbatches[0] == epoch:
+      return self.epochbatches[1]
+    rng = np.random.default_rng(self.seed + epoch)
+    order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+    batches = []
+    for i in range(0, len(order), self.megabatch_size):
+      mega = order[i:i + self.megabatch_size]
+      if self.sort:
+        mega = mega[np.argsort(self.lengths[mega], kind='stable')]
+      batches.extend(self.pack(mega))
+    if self.shuffle:
+      batches = [ batches[i] for i in rng.permutation(len(batches)) ]
+    self.epochbatches = (epoch, batches)
+    return batches
+
+  def __iter__(self):
+    self.numitercalls += 1
+    self.current = self.batches(self.numitercalls)
+    try:
+      for batch in self.current:
+        yield batch.tolist()
+    finally:
+      self.current = None
+
+  def __len__(self):
+    # during an epoch its own number of batches, otherwise the one of the next epoch (packed once)
+    if self.current is not None:
+      return len(self.current)
+    return len(self.batches(self.numitercalls + 1))
+
 class EvenlyDistributingSampler(torch.utils.data.sampler.BatchSampler):
   '''
+  Arrange the indices of `sampler` into `batch_size` columns and return the rows as batches
+  (see the comment in `__iter__`). The batches are computed from the positions, nothing is
+  materialized for a `SequentialSampler`, other samplers are listed once per epoch. With
+  `drop_last = False` the remaining `len(sampler) % batch_size` indices are returned as a
+  last, smaller batch. `state_dict()` holds the number of batches returned in the current
+  epoch and `load_state_dict()` makes the next epoch start after these batches. If batches
+  are prefetched (workers, `PrefetchingLoader`) count the consumed batches yourself and
+  restore with `load_state_dict({ 'batch': nconsumed })`.
+
+  For data parallel training the data is arranged into `num_replicas * batch_size` columns and
+  process `rank` gets the columns `rank * batch_size ... (rank + 1) * batch_size - 1`, so the
+  hidden state carried by every process stays contiguous and all processes have the same number
+  of batches. Without `drop_last` the remainder is split among the processes (and dropped if it
+  is smaller than `num_replicas`).
+
   Test:
     
     [[chr(i+ord('a')) for i in batch] for batch in EvenlyDistributingSampler(SequentialSampler(list(range(25))), batch_size=4, drop_last=True)]
     
   '''  
-  def __init__(self, sampler, batch_size, drop_last, *args, **kwargs):
+  def __init__(self, sampler, batch_size, drop_last, num_replicas = 1, rank = 0, *args, **kwargs):
     super(EvenlyDistributingSampler, self).__init__(sampler, batch_size, drop_last, *args, **kwargs)
-    if not drop_last:
-      raise NotImplementedError('Drop last is not yet implemented for `EvenlyDistributingSampler`.')
+    if not 0 <= rank < num_replicas:
+      raise ValueError(f'Invalid rank {rank:d}, rank should be in the interval [0, {num_replicas - 1:d}].')
     self.sampler = sampler
     self.batch_size = batch_size
+    self.drop_last = drop_last
+    self.num_replicas = num_replicas
+    self.rank = rank
+    self.startbatch = 0
+    self.nextbatch = 0
+
+  def __len__(self):
+    n, ncols = len(self.sampler), self.batch_size * self.num_replicas
+    return n // ncols + int(not self.drop_last and n % ncols >= self.num_replicas)
+
+  def state_dict(self):
+    return { 'batch': self.nextbatch }
+
+  def load_state_dict(self, state):
+    self.startbatch = self.nextbatch = state['batch']
+    return self
     
   def __iter__(self):        
     # Starting from sequential data, batchify arranges the dataset into columns.
@@ -229,15 +679,105 @@ class EvenlyDistributingSampler(torch.utils.data.sampler.BatchSampler):
     #
     
     # each sampler returns indices, use those indices
-    data = torch.LongTensor(list(self.sampler))
-    nbatch = data.size(0) // self.batch_size
-    data = data.narrow(0, 0, nbatch * self.batch_size)
-    data = data.view(self.batch_size, -1).t() # this is important!
-    
-    for row_as_batch in data:
-      yield row_as_batch.tolist()
+    start, self.startbatch = self.startbatch, 0
+    nbatch, batch = self.resolver()
+    for i in range(start, nbatch):
+      self.nextbatch = i + 1
+      yield batch(i)
+    self.nextbatch = 0
+
+  def resolver(self):
+    # row i of the view above holds the positions i, i + nbatch, i + 2*nbatch, ... which are
+    # computed directly (only for the columns of this rank), the remainder (only without
+    # drop_last) is the last batch
+    n = len(self.sampler)
+    ncols = self.batch_size * self.num_replicas
+    nbatch = n // ncols
+    first, last = self.rank * self.batch_size * nbatch, (self.rank + 1) * self.batch_size * nbatch
+    nrest = n - nbatch * ncols
+    rest = range(nbatch * ncols + nrest * self.rank // self.num_replicas, nbatch * ncols + nrest * (self.rank + 1) // self.num_replicas)
+    indices = None
+    if not isinstance(self.sampler, torch.utils.data.sampler.SequentialSampler):
+      indices = np.fromiter(iter(self.sampler), dtype=np.int64, count=n)
+    def batch(i):
+      positions = range(first + i, last, nbatch) if i < nbatch else rest
+      return list(positions) if indices is None else indices[positions.start:positions.stop:positions.step].tolist()
+    return len(self), batch
 
       
+class PrefetchingLoader(object):
+  '''
+  Wrap a DataLoader (or any iterable of batches) and prepare the next `nprefetch` batches
+  in a background thread while the current batch is processed, the order of the batches is
+  preserved. Tensors can be copied to pinned memory (for faster host to gpu copies) or to
+  shared memory. `waittime` is the number of seconds the consumer waited for batches
+  during the current (or last) epoch.
+
+    loader = PrefetchingLoader(torch.utils.data.DataLoader(...), nprefetch = 4)
+  '''
+  def __init__(self, loader, nprefetch = 2, pin_memory = False, share_memory = False):
+    self.loader = loader
+    self.nprefetch = max(1, nprefetch)
+    self.pin_memory = pin_memory and torch.cuda.is_available()
+    self.share_memory = share_memory
+    self.waittime = 0.
+
+  def __len__(self):
+    return len(self.loader)
+
+  def prepare(self, batch):
+    if isinstance(batch, torch.Tensor):
+      if self.pin_memory and batch.device.type == 'cpu':
+        # only pin the batch itself, not everything a strided view reaches; data on the gpu is not pinned
+        batch = batch.contiguous().pin_memory()
+      if self.share_memory and not batch.is_shared():
+        # views, e.g. from `FixedLengthSequenceDataset.getbatch`, must not move the whole storage
+        batch = batch.clone().share_memory_()
+      return batch
+    if isinstance(batch, (list, tuple)):
+      return type(batch)(map(self.prepare, batch))
+    return batch
+
+  def __iter__(self):
+    batches = queue.Queue(maxsize=self.nprefetch)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+      while not stop.is_set():
+        try:
+          batches.put(item, timeout=.1)
+          return True
+        except queue.Full:
+          continue
+      return False
+
+    def produce():
+      try:
+        for batch in self.loader:
+          if not put((self.prepare(batch), None)):
+            return
+        put((end, None))
+      except Exception as e:
+        put((end, e))
+
+    self.waittime = 0.
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+      while True:
+        t = time.time()
+        batch, error = batches.get()
+        self.waittime += time.time() - t
+        if batch is end:
+          if error is not None:
+            raise error
+          return
+        yield batch
+    finally:
+      stop.set()
+
+  
 class SimpleSGD(torch.optim.Optimizer):
 
   def __init__(self, params, *args, lr=requiredParam, **kwargs):
@@ -265,6 +805,8 @@ def createWrappedOptimizerClass(optimizer_clazz):
     - get the current learning rate of an optimizer
     - adjust the learning rate by a factor
     - perform clipping of gradients before a step
+  With `DistributedDataParallel` the gradients are already averaged over all processes when
+  `step()` clips them, so every process clips with the same norm and stays in sync.
   '''
   class Wrapped(optimizer_clazz):
     def __init__(self,  *args, clip = 0.2, **kwargs):
@@ -292,6 +834,22 @@ def createWrappedOptimizerClass(optimizer_clazz):
     
   return Wrapped
 
+def compactIntType(nvalues):
+  '''
+  Smallest integer type which can hold the ids 0 .. nvalues-1, ids stored in such a
+  type must be widened with `.long()` before they are fed into `torch.nn.Embedding`.
+  '''
+  if nvalues <= 1 << 8:
+    return torch.uint8
+  if nvalues <= 1 << 15:
+    return torch.int16
+  if nvalues <= 1 << 31:
+    return torch.int32
+  return torch.int64
+
+def tensorBytes(*tensors):
+  return sum(t.numel() * t.element_size() for t in tensors)
+
 def makeOneHot(X, ntoken):
   # X = batch_size x seq
   batch_size, seqlen = X.size()
@@ -302,6 +860,19 @@ def makeOneHot(X, ntoken):
 def makeBow(X_one_hot):
    X_bow = X_one_hot.sum(dim=1)
    return X_bow
+
+def makeSparseOneHot(X, ntoken):
+  # X = batch_size x seq, same as `makeOneHot` but as sparse (COO) tensor
+  batch_size, seqlen = X.size()
+  b = torch.arange(batch_size, device=X.device).repeat_interleave(seqlen)
+  s = torch.arange(seqlen, device=X.device).repeat(batch_size)
+  return torch.sparse_coo_tensor(torch.stack((b, s, X.reshape(-1))), X.new_ones(X.numel(), dtype=torch.float), (batch_size, seqlen, ntoken), check_invariants=False)
+
+def makeSparseBow(X, ntoken):
+  # X = batch_size x seq, same as `makeBow(makeOneHot(X, ntoken))` but as sparse (COO) batch_size x ntoken tensor
+  batch_size, seqlen = X.size()
+  b = torch.arange(batch_size, device=X.device).repeat_interleave(seqlen)
+  return torch.sparse_coo_tensor(torch.stack((b, X.reshape(-1))), X.new_ones(X.numel(), dtype=torch.float), (batch_size, ntoken), check_invariants=False).coalesce()
       
 class SimpleRepl(object):
   '''